@@ -0,0 +1,31 @@
+import random
+
+
+class Backoff:
+    """jittered exponential backoff for reconnecting: every delay is twice the previous one (up to 'maximum'),
+    randomized so that multiple clients don't all retry at the same moment.
+    """
+
+    def __init__(self, initial=1.0, maximum=60.0, factor=2.0, jitter=0.5):
+        """
+        Args:
+            initial (number): the first delay in seconds
+            maximum (number): the delay never gets bigger than this
+            factor (number): multiplier for the next delay
+            jitter (number): fraction of the delay that is randomized, 0.5 -> between 50% and 100% of the delay
+        """
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+
+    def next(self):
+        """the delay before the next attempt
+        """
+        delay = min(self.maximum, self.initial * self.factor ** self.attempts)
+        self.attempts += 1
+        return delay * (1 - self.jitter * random.random())
+
+    def reset(self):
+        self.attempts = 0
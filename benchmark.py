@@ -0,0 +1,677 @@
+"""micro-benchmarks for the hot paths of the bridge.
+usage: python benchmark.py [name ...]      (no name: run all of them)
+"""
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+import codec
+import teletask
+import teletask_const as const
+from fake_mqtt import FakeMQTTClient
+from simulator import Simulator, build_frame
+
+
+def build_report_stream(nr_frames):
+    """a stream of relay, motor & sensor reports, like teletask sends them during a mood
+    """
+    frames = []
+    for i in range(nr_frames):
+        nr = i % 40 + 1
+        if i % 3 == 0:
+            frames.append(build_frame([const.COMMAND_REPORT, 1, const.FNC_RELAY, 0, nr, 0, 255]))
+        elif i % 3 == 1:
+            frames.append(build_frame([const.COMMAND_REPORT, 1, const.FNC_MOTORFNC, 0, nr, 0, 1, 1]))
+        else:
+            frames.append(build_frame([const.COMMAND_REPORT, 1, const.FNC_SENSOR, 0, nr, 0, 0x0B, 0x7A, 0x0B, 0x7A, 0x0B, 0x7A, 0x0B, 0x7A]))
+        if i % 10 == 0:
+            frames.append(bytes([const.COMMAND_ACK]))
+    return b''.join(frames)
+
+
+def split_in_reads(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def legacy_parse(data):
+    """the list based parsing that teletask.read_messages used to do, for comparison
+    """
+    bytes = []
+    for x in data:
+        bytes.append(x)
+    curPos = 0
+    msgs = []
+    while curPos < len(bytes):
+        if bytes[curPos] == const.COMMAND_ACK:
+            curPos += 1
+        elif bytes[curPos] != 0x02:
+            curPos += 1
+        elif curPos + 1 >= len(bytes):
+            break
+        else:
+            length = bytes[curPos + 1]
+            msg = bytes[curPos:curPos + length + 1]
+            if teletask.get_checksum(msg[:-1]) == msg[-1]:
+                msgs.append(msg)
+            curPos += length + 1
+    return msgs
+
+
+def build_assets(nr_assets):
+    """a config like the one in config.json: relays, dimmers, covers & sensors
+    """
+    assets = []
+    for i in range(nr_assets):
+        nr = i // 4 + 1
+        kind = i % 4
+        if kind == 0:
+            assets.append({"name": "light {}".format(nr), "component": "light", "teletask_type": "relay", "central_unit": 1, "teletask_id": nr})
+        elif kind == 1:
+            assets.append({"name": "dimmer {}".format(nr), "component": "light", "teletask_type": "dimmer", "central_unit": 1, "teletask_id": nr})
+        elif kind == 2:
+            assets.append({"name": "cover {}".format(nr), "component": "cover", "teletask_type": "motor", "central_unit": 1, "teletask_id": nr})
+        else:
+            assets.append({"name": "sensor {}".format(nr), "component": "sensor", "teletask_type": "sensor", "central_unit": 1, "teletask_id": nr})
+    return assets
+
+
+def build_events(assets, nr_events):
+    """the (unit, fnc, nr, values) tuples that teletask.process_message would produce for the assets
+    """
+    events = []
+    for i in range(nr_events):
+        asset = assets[i % len(assets)]
+        unit, fnc, nr = teletask.get_id(asset)
+        if fnc == const.FNC_MOTORFNC:
+            values = [1, 1]
+        elif fnc == const.FNC_SENSOR:
+            values = codec.SensorState(21.5, 21.0, 21.0, 18.0)
+        else:
+            values = [i % 2 * 255]
+        events.append((unit, fnc, nr, values))
+    return events
+
+
+def legacy_get_value(asset, value, as_dimmer=False):
+    """the value conversion HA.send used to do for every event
+    """
+    component = asset['component']
+    result = None
+    if component == 'light':
+        if not as_dimmer:
+            result = 'OFF' if value[0] == 0 else 'ON'
+    elif component == 'cover':
+        if value[1] == 0:
+            result = 'stopped'
+        elif value[0] == 2:
+            result = 'closing'
+        else:
+            result = 'opening'
+    elif component == 'sensor':
+        result = '{}'.format(value)
+    if result == None:
+        return value
+    return bytearray(result, 'utf-8')
+
+
+def legacy_dispatch(assets_dict, client, unit, fnc, nr, values):
+    """the string based event path: type conversion, key building, lookup, key & topic building
+    """
+    key = teletask.build_key(unit, teletask.function_to_teletask_type(fnc), nr)
+    if key in assets_dict:
+        asset = assets_dict[key]
+        key = teletask.build_key_from_asset(asset)
+        topic = '{}/{}/{}/{}/state'.format('homeassistant', asset['component'], 'teletask_1', key)
+        to_send = legacy_get_value(asset, values)
+        print("publishing to: {}, value: {}".format(topic, to_send))
+        client.publish(topic, to_send, qos=0)
+        if asset['teletask_type'] == 'dimmer':
+            topic = '{}/{}/{}/{}/statebri'.format('homeassistant', asset['component'], 'teletask_1', key)
+            to_send = legacy_get_value(asset, values, True)
+            print("publishing to: {}, value: {}".format(topic, to_send))
+            client.publish(topic, to_send, qos=0)
+
+
+def bench_dispatch(nr_assets=150, nr_events=100000):
+    """events/sec from decoded teletask event to mqtt publish, string keys vs the route index.
+    Every event has a new value for its asset, so both paths publish every event.
+    """
+    import home_assistant as HA
+
+    assets = build_assets(nr_assets)
+    events = []
+    for i, (unit, fnc, nr, values) in enumerate(build_events(assets, nr_events)):
+        flip = i // nr_assets % 2                                               # every value differs from the previous one of the asset
+        if fnc == const.FNC_MOTORFNC:
+            values = [1 + flip, 1]
+        elif fnc == const.FNC_SENSOR:
+            values = codec.SensorState(21.5 + flip, 21.0, 21.0, 18.0)
+        else:
+            values = [flip * 255]
+        events.append((unit, fnc, nr, values))
+    client = FakeMQTTClient()
+
+    assets_dict = {teletask.build_key_from_asset(asset): asset for asset in assets}
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):       # the old path printed every publish, keep it off the console
+        start = time.perf_counter()
+        for unit, fnc, nr, values in events:
+            legacy_dispatch(assets_dict, client, unit, fnc, nr, values)
+        legacy_duration = time.perf_counter() - start
+        legacy_publishes = len(client.publishes)
+
+        HA.client = client
+        HA.is_connected = True                                                  # publish right away instead of keeping the states for a resync
+        HA.last_published.clear()
+        routes = {teletask.get_id(asset): HA.build_route(asset) for asset in assets}
+        send = HA.send
+        start = time.perf_counter()
+        for unit, fnc, nr, values in events:
+            route = routes.get((unit, fnc, nr))
+            if route:
+                send(route, values)
+        duration = time.perf_counter() - start
+        HA.client = None
+        HA.is_connected = False
+        HA.last_published.clear()
+    report('string keys', nr_events, legacy_duration, 'events')
+    report('route index', nr_events, duration, 'events')
+    print('publishes: string keys {}, route index {}'.format(legacy_publishes, len(client.publishes) - legacy_publishes))
+
+
+def report(name, count, duration, unit='frames'):
+    print('{:<40} {:>12.0f} {}/sec'.format(name, count / duration, unit))
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def report_latency(name, values):
+    print('{:<40} avg {:.2f} ms, p50 {:.2f} ms, p99 {:.2f} ms'.format(
+        name, sum(values) / len(values) * 1000, percentile(values, 50) * 1000, percentile(values, 99) * 1000))
+
+
+def bench_parser(nr_frames=20000, read_size=100):
+    """frames/sec of the FrameParser compared to the old list based path
+    """
+    reads = split_in_reads(build_report_stream(nr_frames), read_size)
+    start = time.perf_counter()
+    found = 0
+    for data in reads:
+        found += len(legacy_parse(data))
+    report('legacy list parser (drops split frames)', found, time.perf_counter() - start)
+
+    parser = teletask.FrameParser()
+    start = time.perf_counter()
+    found = 0
+    for data in reads:
+        found += len(parser.feed(data))
+    report('FrameParser', found, time.perf_counter() - start)
+    print('frames found: {} of {}'.format(found, nr_frames))
+
+
+def legacy_decode(msg):
+    """the if/elif decoding of a report that process_message used to do
+    """
+    unit = msg[1]
+    fnc = msg[2]
+    nr = int.from_bytes(msg[3:5], "big")
+    if fnc == const.FNC_MOTORFNC:
+        values = [msg[6], msg[7]]
+    elif fnc == const.FNC_SENSOR:
+        values = round(int.from_bytes(msg[6:8], "big") / 10 - 273, 2)
+    else:
+        values = [msg[6]]
+    return unit, fnc, nr, values
+
+
+def bench_codec(nr_frames=20000, repeat=10):
+    """reports/sec decoded, the if/elif chain vs the struct layouts of the codec
+    """
+    frames = [memoryview(frame)[2:] for frame in teletask.FrameParser().feed(build_report_stream(nr_frames))]
+    start = time.perf_counter()
+    for i in range(repeat):
+        for msg in frames:
+            legacy_decode(msg)
+    report('if/elif decode (sensor value only)', len(frames) * repeat, time.perf_counter() - start)
+
+    decode = codec.decode_report
+    start = time.perf_counter()
+    for i in range(repeat):
+        for msg in frames:
+            decode(msg)
+    report('codec decode (all sensor fields)', len(frames) * repeat, time.perf_counter() - start)
+
+
+def bench_filter(nr_assets=150, nr_frames=20000, repeat=10):
+    """frames/sec for reports of assets that aren't in the config (all the functions logged):
+    parsed, decoded and then ignored vs dropped by the parser on the frame key
+    """
+    assets = build_assets(nr_assets)
+    routes = {teletask.get_id(asset) for asset in assets}
+    monitored = {teletask.get_asset_key(*id) for id in routes}
+    stream = bytearray()
+    for i in range(nr_frames):                                  # nrs 256 - 455, none of them are configured
+        stream += build_frame([const.COMMAND_REPORT, 1, const.FNC_RELAY, 1, i % 200, 0, 255])
+    stream = bytes(stream)
+
+    start = time.perf_counter()
+    for i in range(repeat):
+        for frame in teletask.FrameParser().feed(stream):
+            unit, fnc, nr, values = codec.decode_report(memoryview(frame)[2:])
+            if (unit, fnc, nr) in routes:
+                pass
+    report('parse, decode & ignore', nr_frames * repeat, time.perf_counter() - start)
+
+    kept = 0
+    start = time.perf_counter()
+    for i in range(repeat):
+        kept += len(teletask.FrameParser(monitored=monitored).feed(stream))
+    report('drop on the frame key', nr_frames * repeat, time.perf_counter() - start)
+    print('frames dropped: {} of {}'.format(nr_frames - kept // repeat, nr_frames))
+
+
+@contextlib.asynccontextmanager
+async def running_bridge(assets, ack_delay=0.0, sections=None):
+    """runs main.main against the teletask simulator, with a FakeMQTTClient instead of the broker connection,
+    in a temp dir (main works with config.json & covers.json in the current dir)
+    Args:
+        assets (list): the assets in the config
+        ack_delay (number): nr of seconds before the simulator acks a command
+        sections (dict): extra sections for the config
+    Yields:
+        (Simulator, FakeMQTTClient): once all the assets are loaded
+    """
+    import home_assistant as HA
+    import main
+
+    simulator = Simulator(ack_delay=ack_delay)
+    port = await simulator.start()
+    config = {
+        "home_assistant": {"discovery_prefix": "homeassistant", "client_id": "benchmark", "broker_host": "localhost", "device_id": "teletask_1"},
+        "teletask": {"ip": "127.0.0.1", "port": port},
+        "assets": assets
+    }
+    config.update(sections or {})
+    clients = []
+    def create_client(client_id):
+        clients.append(FakeMQTTClient(client_id))
+        return clients[-1]
+    HA.MQTTClient = create_client
+    HA.last_published.clear()
+    main.STOP = asyncio.Event()                                 # could be a previous run in this process (on another loop)
+
+    loaded = asyncio.Event()
+    load_assets = main.load_assets
+    async def load_and_signal(*args):
+        await load_assets(*args)
+        loaded.set()
+    main.load_assets = load_and_signal
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        bridge = None
+        try:
+            with open('config.json', 'w') as file:
+                json.dump(config, file)
+            start = time.perf_counter()
+            bridge = asyncio.create_task(main.main(asyncio.get_running_loop()))
+            await asyncio.wait_for(loaded.wait(), 60)
+            print('{:<40} {:.2f} sec'.format('startup incl. state sync', time.perf_counter() - start))
+            yield simulator, clients[0]
+        finally:
+            main.STOP.set()
+            if bridge:
+                await bridge
+            await simulator.stop()
+            main.load_assets = load_assets
+            os.chdir(cwd)
+
+
+async def run_e2e(nr_assets, nr_events, nr_commands):
+    import main
+
+    async with running_bridge(build_assets(nr_assets)) as (simulator, client):
+        rtts = []                                           # ack round trip, 1 command at a time
+        for i in range(nr_commands):
+            start = time.perf_counter()
+            await teletask.get_connection(1).send([const.COMMAND_KEEP_ALIVE])
+            rtts.append(time.perf_counter() - start)
+        report_latency('ack round trip', rtts)
+
+        start = time.perf_counter()
+        connection = teletask.get_connection(1)
+        await asyncio.gather(*[connection.send([const.COMMAND_KEEP_ALIVE]) for i in range(nr_commands)])
+        report('pipelined commands', nr_commands, time.perf_counter() - start, 'commands')
+
+        topics = {}                                         # state topic -> teletask id, covers are left out, they move
+        for id, route in main.routes.items():
+            if not route.is_cover:
+                topics[route.state_topic] = id
+        simulator.sent_at.clear()
+        client.publishes.clear()
+        start = time.perf_counter()
+        await simulator.storm([id[1:] for id in topics.values()], nr_events)
+        while sum(1 for publish in client.publishes if publish.topic in topics) < nr_events and time.perf_counter() - start < 30:
+            await asyncio.sleep(0.01)
+        latencies = []
+        for publish in client.publishes:
+            if publish.topic in topics:
+                sent = simulator.sent_at[topics[publish.topic]]
+                latencies.append(publish.at - sent.pop(0))
+        if latencies:
+            last = max(publish.at for publish in client.publishes if publish.topic in topics)
+            report('teletask events to mqtt', len(latencies), last - start, 'events')
+            report_latency('teletask to mqtt latency', latencies)
+        print('events published: {} of {}'.format(len(latencies), nr_events))
+
+
+def bench_e2e(nr_assets=150, nr_events=5000, nr_commands=500):
+    """runs the bridge against the teletask simulator (mqtt client replaced by a recorder):
+    ack round trip, events/sec and teletask to mqtt latency
+    """
+    asyncio.run(run_e2e(nr_assets, nr_events, nr_commands))
+
+
+async def run_mqtt(nr_assets, nr_publishes, nr_commands):
+    import home_assistant as HA
+
+    assets = build_assets(nr_assets)
+    HA.MQTTClient = FakeMQTTClient
+    await HA.start({"discovery_prefix": "homeassistant", "client_id": "benchmark", "broker_host": "localhost", "device_id": "teletask_1", "discovery_cache": ""}, None, asyncio.get_running_loop())
+    start = time.perf_counter()
+    await HA.load_assets(assets)
+    duration = time.perf_counter() - start
+    print('{:<40} {:.2f} ms for {} assets, {} publishes'.format('discovery', duration * 1000, nr_assets, len(HA.client.publishes)))
+
+    routes = [HA.build_route(asset) for asset in assets if asset['component'] != 'cover']
+    events = build_events([route.asset for route in routes], nr_publishes)     # same order as the routes
+    HA.last_published.clear()
+    start = time.perf_counter()
+    published = len(HA.client.publishes)
+    for i, (unit, fnc, nr, values) in enumerate(events):
+        flip = i // len(routes) % 2                                             # every value differs from the previous one of the asset, so nothing is skipped
+        values = (20.0 + flip,) if fnc == const.FNC_SENSOR else [flip * 255]
+        HA.send(routes[i % len(routes)], values)
+    duration = time.perf_counter() - start
+    report('state publishes', len(HA.client.publishes) - published, duration, 'publishes')
+    await HA.stop()
+
+    relays = [asset for asset in assets if asset['teletask_type'] == 'relay']
+    async with running_bridge(assets) as (simulator, client):
+        received = None
+        def on_command(msg):
+            if msg[0] == const.COMMAND_SET and not received.done():
+                received.set_result(time.perf_counter())
+        simulator.on_command = on_command
+        rtts = []
+        loop = asyncio.get_running_loop()
+        for i in range(nr_commands):
+            asset = relays[i % len(relays)]
+            topic = '{}/set'.format(HA.build_base_topic(asset, teletask.build_key_from_asset(asset)))
+            received = loop.create_future()
+            start = time.perf_counter()
+            client.deliver(topic, b'ON' if i % 2 else b'OFF')
+            rtts.append(await asyncio.wait_for(received, 5) - start)
+        report_latency('mqtt command to teletask SET', rtts)
+
+
+def bench_mqtt(nr_assets=150, nr_publishes=50000, nr_commands=500):
+    """the home assistant side: discovery time, state publish rate and the time from an mqtt
+    command (on_message) to the SET frame arriving at the teletask simulator
+    """
+    asyncio.run(run_mqtt(nr_assets, nr_publishes, nr_commands))
+
+
+def legacy_on_message(on_actuator, topic, payload):
+    """the string based command path: decode the payload, split the topic and the key of every message
+    """
+    payload = payload.decode()
+    topic_parts = topic.split('/')
+    teletask_parts = topic_parts[3].split('_')
+    if len(teletask_parts) >= 3:
+        on_actuator(teletask_parts[0], teletask_parts[1], teletask_parts[2], payload)
+
+
+def bench_inbound(nr_assets=150, nr_messages=200000):
+    """messages/sec from mqtt on_message to the actuator callback, splitting the topic vs the topic router
+    """
+    import home_assistant as HA
+
+    received = []
+    def on_actuator(*args):                                     # only the routing is measured, not handling the commands
+        received.append(args)
+
+    assets = build_assets(nr_assets)
+    HA.client = FakeMQTTClient()
+    HA.discovery_prefix = 'homeassistant'
+    HA.node_id = 'teletask_1'
+    HA.discovery_store = None
+    HA.on_actuator = on_actuator
+    HA.publish_discovery(assets, build_router=True)
+    topics = list(HA.router)
+    messages = [(topics[i % len(topics)], b'ON' if i % 2 else b'OFF') for i in range(nr_messages)]
+
+    start = time.perf_counter()
+    for topic, payload in messages:
+        legacy_on_message(on_actuator, topic, payload)
+    legacy_duration = time.perf_counter() - start
+
+    received.clear()
+    on_message = HA.on_message
+    start = time.perf_counter()
+    for topic, payload in messages:
+        on_message(None, topic, payload, 0, None)
+    duration = time.perf_counter() - start
+    assert len(received) == nr_messages
+    report('split topic', nr_messages, legacy_duration, 'messages')
+    report('topic router', nr_messages, duration, 'messages')
+
+
+def bench_metrics(nr_ops=1000000):
+    """cost of the instrumentation on the event path: a counter increment and a timed histogram observation
+    """
+    import metrics
+
+    counter = metrics.Counter()
+    start = time.perf_counter()
+    for i in range(nr_ops):
+        counter.inc()
+    duration = time.perf_counter() - start
+    print('{:<40} {:.0f} ns/op'.format('counter.inc', duration / nr_ops * 1e9))
+
+    histogram = metrics.Histogram(metrics.LATENCY_BUCKETS)
+    perf_counter = time.perf_counter
+    start = time.perf_counter()
+    for i in range(nr_ops):
+        at = perf_counter()
+        histogram.observe(perf_counter() - at)
+    duration = time.perf_counter() - start
+    print('{:<40} {:.0f} ns/op'.format('timed histogram.observe', duration / nr_ops * 1e9))
+
+    start = time.perf_counter()
+    for i in range(1000):
+        json.dumps(metrics.snapshot())
+    print('{:<40} {:.1f} us'.format('snapshot as json', (time.perf_counter() - start) / 1000 * 1e6))
+
+
+async def run_covers(nr_covers, duration, interval):
+    import roller_shutters as RS
+
+    reported = []
+    RS.store.mark_dirty = lambda: None                         # don't write covers.json
+    RS.COVER_DATA = {str(i): {'position': 0, 'duration_up': duration, 'duration_down': duration} for i in range(nr_covers)}
+    RS.start({'position_interval': interval}, lambda key, position: reported.append(position))
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    now = time.monotonic()
+    for key, cover in RS.COVER_DATA.items():
+        RS.begin_move(key, cover, 'OPEN', now)
+    await asyncio.sleep(duration)
+    for key, cover in RS.COVER_DATA.items():
+        RS.end_move(key, cover, 100)
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - start
+    print('{:<40} {} covers, {} positions reported in {:.1f} s'.format('covers moving', nr_covers, len(reported), wall))
+    print('{:<40} {:.2f} %'.format('cpu while moving', cpu / wall * 100))
+
+
+def bench_covers(nr_covers=25, duration=5.0, interval=0.1):
+    """position reporting of a lot of covers that move together, driven by 1 timer
+    """
+    asyncio.run(run_covers(nr_covers, duration, interval))
+
+
+async def run_calibrate(nr_covers, max_motors):
+    import roller_shutters as RS
+
+    running = []
+    peak = [0]
+    async def set_actuator(asset, value):                       # a motor that reaches the end after the duration of the cover
+        if value == 'STOP':
+            return True
+        running.append(asset)
+        peak[0] = max(peak[0], len(running))
+        async def finish():
+            await asyncio.sleep(asset['duration'])
+            running.remove(asset)
+            direction = const.SET_MTRUP if value == 'OPEN' else const.SET_MTRDOWN
+            await RS.handle_cover_event(asset['key'], asset, codec.MotorState(direction, 0))
+        asyncio.ensure_future(finish())
+        return True
+
+    covers = [{"name": "cover {}".format(i), "key": str(i), "duration": 0.2 + 0.01 * i} for i in range(nr_covers)]
+    covers[0]['duration'] = 0.01                                # a cover that doesn't really move: too short, without previous calibration
+    build_key_from_asset = teletask.build_key_from_asset
+    teletask_set_actuator = teletask.set_actuator
+    teletask.build_key_from_asset = lambda asset: asset['key']
+    teletask.set_actuator = set_actuator
+    save = RS.store.mark_dirty
+    RS.store.mark_dirty = lambda: None                         # don't write covers.json
+    progress = []
+    try:
+        RS.COVER_DATA = {}
+        RS.start({'calibration_max_motors': max_motors, 'calibration_spacing': 0.01, 'calibration_min_duration': 0.1, 'calibration_timeout': 5},
+                 None, lambda item: progress.append(dict(item)))
+        start = time.perf_counter()
+        calibrated = await RS.calibrate(covers)
+        duration = time.perf_counter() - start
+    finally:
+        teletask.build_key_from_asset = build_key_from_asset
+        teletask.set_actuator = teletask_set_actuator
+        RS.store.mark_dirty = save
+    print('{:<40} {} of {} covers in {:.2f} s, max {} motors running'.format('calibration', len(calibrated), nr_covers, duration, peak[0]))
+    print('{:<40} state {}, failed: {}'.format('calibration progress', progress[-1]['state'], progress[-1]['failed']))
+
+
+def bench_calibrate(nr_covers=12, max_motors=4):
+    """calibration of a lot of covers with simulated motors, within the motor budget, the first cover
+    is too short (an outlier without a previous calibration)
+    """
+    asyncio.run(run_calibrate(nr_covers, max_motors))
+
+
+async def run_coalesce(nr_messages, interval, ack_delay):
+    import home_assistant as HA
+    import main
+
+    assets = build_assets(4)
+    dimmer = [asset for asset in assets if asset['teletask_type'] == 'dimmer'][0]
+    topic = '{}/setbri'.format(HA.build_base_topic(dimmer, teletask.build_key_from_asset(dimmer)))
+    coalesce_types = main.coalesce_types
+    for name, types in (('every command', set()), ('latest wins', coalesce_types)):
+        main.coalesce_types = types
+        async with running_bridge(assets, ack_delay, {"commands": {"max_queued_per_asset": nr_messages}}) as (simulator, client):
+            sets = []
+            def on_command(msg):
+                if msg[0] == const.COMMAND_SET and msg[2] == const.FNC_DIMMER:
+                    sets.append((msg[5], time.perf_counter()))
+            simulator.on_command = on_command
+            for i in range(nr_messages):                   # dragging the slider
+                if i:
+                    await asyncio.sleep(interval)
+                last_at = time.perf_counter()
+                client.deliver(topic, '{}'.format(i + 1).encode())
+            while not sets or sets[-1][0] != nr_messages:
+                await asyncio.sleep(0.001)
+            print('{:<40} {} SET frames for {} messages, last value after {:.1f} ms'.format(name, len(sets), nr_messages, (sets[-1][1] - last_at) * 1000))
+    main.coalesce_types = coalesce_types
+
+
+def bench_coalesce(nr_messages=50, interval=0.005, ack_delay=0.02):
+    """a burst of brightness commands for 1 dimmer (slider), with a unit that needs some time to ack:
+    the nr of SET frames and the time until the last value is set, with & without latest-wins coalescing
+    """
+    asyncio.run(run_coalesce(nr_messages, interval, ack_delay))
+
+
+def bench_startup(nr_assets=500, nr_loads=20):
+    """the startup path: loading the config without (cold) and with (warm) the validated cache,
+    and the time to import main in a new process
+    """
+    import subprocess
+    import config as Config
+
+    assets = build_assets(nr_assets)
+    config = {
+        "home_assistant": {"discovery_prefix": "homeassistant", "client_id": "benchmark", "broker_host": "localhost", "device_id": "teletask_1"},
+        "teletask": {"ip": "127.0.0.1", "port": 55957},
+        "assets": assets
+    }
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        try:
+            with open('config.json', 'w') as file:
+                json.dump(config, file)
+            cold = []
+            warm = []
+            for i in range(nr_loads):
+                if os.path.exists(Config.CACHE_FILE):
+                    os.remove(Config.CACHE_FILE)
+                start = time.perf_counter()
+                Config.load()
+                cold.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                Config.load()
+                warm.append(time.perf_counter() - start)
+        finally:
+            os.chdir(cwd)
+    print('{:<40} {:.2f} ms for {} assets'.format('config load, cold', percentile(cold, 50) * 1000, nr_assets))
+    print('{:<40} {:.2f} ms for {} assets'.format('config load, warm (cached)', percentile(warm, 50) * 1000, nr_assets))
+
+    code = 'import time; start = time.perf_counter(); import main, sys; print(time.perf_counter() - start, "gmqtt" in sys.modules)'
+    times = []
+    for i in range(5):
+        output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True).stdout.split()
+        times.append(float(output[0]))
+    print('{:<40} {:.1f} ms (gmqtt imported: {})'.format('import main', percentile(times, 50) * 1000, output[1]))
+
+
+BENCHMARKS = {
+    'parser': bench_parser,
+    'codec': bench_codec,
+    'filter': bench_filter,
+    'dispatch': bench_dispatch,
+    'e2e': bench_e2e,
+    'mqtt': bench_mqtt,
+    'inbound': bench_inbound,
+    'covers': bench_covers,
+    'calibrate': bench_calibrate,
+    'startup': bench_startup,
+    'coalesce': bench_coalesce,
+    'metrics': bench_metrics,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print('--- {}'.format(name))
+        BENCHMARKS[name]()
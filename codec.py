@@ -0,0 +1,112 @@
+"""encoding & decoding of the teletask messages. Every function (FNC_*) has a layout with the struct
+formats of its report & SET messages, compiled once, so a message is decoded with a table lookup
+and a single unpack.
+"""
+import struct
+from collections import namedtuple
+
+import teletask_const as const
+
+KELVIN = 2730                               # sensors report in 0.1 kelvin
+
+State = namedtuple('State', 'value')                                    # relay, flag, moods, ...: 0 = off, 255 = on
+DimmerState = namedtuple('DimmerState', 'level')                        # 0 - 100
+MotorState = namedtuple('MotorState', 'direction state')                # direction: SET_MTRUP or SET_MTRDOWN, state: 0 = stopped
+SensorState = namedtuple('SensorState', 'value target day night')      # degrees celsius, the setpoints are None when not reported
+
+GET = struct.Struct('>BBBH')                # command, central unit, function, nr
+LOG = struct.Struct('>BBB')                 # command, function, on/off
+
+
+def decode_sensor(values):
+    return [(value - KELVIN) / 10 for value in values]         # 1 division of integers, so no rounding errors (2938 -> 20.8)
+
+def encode_sensor(state):
+    return [round(value * 10) + KELVIN for value in state]
+
+
+def build_decoder(values_format, state_type, convert, nr_required):
+    """a function that decodes a report with the values in values_format into (unit, fnc, nr, state)
+    """
+    unpack = struct.Struct('>xBBHx' + values_format).unpack_from           # the command & error state are skipped
+    new = tuple.__new__                                                     # faster than state_type._make, the nr of values is always right
+    if not convert:
+        def decode(msg):
+            fields = unpack(msg)
+            return fields[0], fields[1], fields[2], new(state_type, fields[3:])
+        return decode
+    unpack_short = struct.Struct('>xBBHx' + values_format[:nr_required]).unpack_from if nr_required else None
+    missing = [None] * (len(values_format) - (nr_required or 0))
+    def decode(msg):
+        try:
+            fields = unpack(msg)
+        except struct.error:
+            if not unpack_short:
+                raise
+            fields = unpack_short(msg)
+            return fields[0], fields[1], fields[2], new(state_type, convert(fields[3:]) + missing)
+        return fields[0], fields[1], fields[2], new(state_type, convert(fields[3:]))
+    return decode
+
+
+class Layout:
+    """the format of the values of 1 teletask function
+    """
+    __slots__ = ('report', 'command', 'decode', 'encode')
+
+    def __init__(self, values_format, state_type, decode=None, encode=None, nr_required=None):
+        """
+        Args:
+            values_format (string): struct format of the values in a report (after the error state)
+            state_type (namedtuple): the type of the decoded values
+            decode (func): converts the raw values (tuple) into the values of the state, default: no conversion
+            encode (func): converts the state into the raw values (list), default: the values of the state
+            nr_required (number): nr of values that every report contains, the others are optional (None), default: all
+        """
+        self.report = struct.Struct('>BBBHB' + values_format)           # command, central unit, function, nr, error state, values
+        self.command = struct.Struct('>BBBHB')                          # SET: command, central unit, function, nr, setting
+        self.decode = build_decoder(values_format, state_type, decode, nr_required)
+        self.encode = encode or list
+
+
+DEFAULT = Layout('B', State)
+LAYOUTS = {
+    const.FNC_DIMMER: Layout('B', DimmerState),
+    const.FNC_MOTORFNC: Layout('BB', MotorState),
+    const.FNC_SENSOR: Layout('HHHH', SensorState, decode_sensor, encode_sensor, 1),
+}
+LAYOUTS.update({fnc: DEFAULT for fnc in (const.FNC_RELAY, const.FNC_LOCMOOD, const.FNC_TIMEDMOOD, const.FNC_GENMOOD, const.FNC_FLAG,
+    const.FNC_PROCES, const.FNC_REGIME, const.FNC_SERVICE, const.FNC_MESSAGE, const.FNC_COND, const.FNC_AUDIO)})
+
+
+def decode_report(msg):
+    """decode a REPORT message
+    Args:
+        msg (bytes-like): the frame without start byte & length (a trailing checksum is ignored)
+    Returns:
+        tuple: (central unit, function, nr, state), the state is one of the namedtuples of this module
+    """
+    return LAYOUTS.get(msg[2], DEFAULT).decode(msg)
+
+
+def encode_report(unit, fnc, nr, state):
+    """the REPORT message for the state, the reverse of decode_report (used by the simulator & benchmarks)
+    """
+    layout = LAYOUTS.get(fnc, DEFAULT)
+    return layout.report.pack(const.COMMAND_REPORT, unit, fnc, nr, 0, *layout.encode(state))
+
+
+def encode_set(unit, fnc, nr, setting):
+    """the SET message for an asset
+    Args:
+        setting (number): the value to set, see the SET_* constants
+    """
+    return LAYOUTS.get(fnc, DEFAULT).command.pack(const.COMMAND_SET, unit, fnc, nr, setting)
+
+
+def encode_get(unit, fnc, nr):
+    return GET.pack(const.COMMAND_GET, unit, fnc, nr)
+
+
+def encode_log(fnc, is_on=True):
+    return LOG.pack(const.COMMAND_LOG, fnc, const.SET_ON if is_on else const.SET_OFF)
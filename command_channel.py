@@ -0,0 +1,145 @@
+import asyncio
+import logging
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger('teletask')
+
+FRAMES_OUT = metrics.counter('teletask.frames_out')
+ACK_TIMEOUTS = metrics.counter('teletask.ack_timeouts')
+COMMANDS_FAILED = metrics.counter('teletask.commands_failed')
+ACK_RTT = metrics.histogram('teletask.ack_rtt')
+QUEUE_DEPTH = metrics.histogram('teletask.queue_depth', metrics.DEPTH_BUCKETS)
+
+
+class Command:
+    """a single frame that needs to be sent to teletask, together with the future that
+    gets resolved when it has been acknowledged (True) or finally timed out (False)
+    """
+    __slots__ = ('frame', 'future', 'attempts', 'sent_at')
+
+    def __init__(self, frame, future):
+        self.frame = frame
+        self.future = future
+        self.attempts = 0
+        self.sent_at = None
+
+
+class CommandChannel:
+    """outbound command pipeline for a teletask connection.
+    Multiple commands can be waiting for an ack at the same time (up to 'window'). Teletask acks carry
+    no id but arrive in the order the commands were sent, so acks are matched in fifo order.
+    The oldest command that is in flight gets retried when no ack arrived in time, when all
+    attempts are used up, the caller gets False as result.
+    """
+
+    def __init__(self, write, window=4, timeout=1.0, retries=1):
+        """
+        Args:
+            write (func): called with the bytes of a frame that needs to be written to the socket
+            window (number): max nr of commands that can wait for an ack at the same time
+            timeout (number): nr of seconds to wait for an ack before the command is resent / regarded as lost
+            retries (number): nr of times a command is resent after a timeout
+        """
+        self.write = write
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.queue = deque()                    # commands that still need to be sent
+        self.in_flight = deque()                # commands that were sent and wait for an ack, oldest first
+        self.timer = None                       # timeout handle for the oldest command in flight
+
+    def is_idle(self):
+        return not self.in_flight and not self.queue
+
+    async def submit(self, frame):
+        """queue the frame for sending and wait until it has been processed
+
+        Args:
+            frame (bytes): the full frame to send
+        Returns:
+            bool: True if teletask acknowledged the command, False if it was lost.
+        """
+        command = Command(frame, asyncio.get_running_loop().create_future())
+        QUEUE_DEPTH.observe(len(self.queue) + len(self.in_flight))
+        self.queue.append(command)
+        self.pump()
+        return await command.future
+
+    def pump(self):
+        """sends queued commands as long as the window allows it
+        """
+        while self.queue and len(self.in_flight) < self.window:
+            command = self.queue.popleft()
+            if command.future.done():                   # caller got cancelled, no need to send it anymore
+                continue
+            self.transmit(command)
+
+    def transmit(self, command):
+        command.attempts += 1
+        command.sent_at = asyncio.get_running_loop().time()
+        self.in_flight.append(command)
+        FRAMES_OUT.inc()
+        try:
+            self.write(command.frame)
+        except Exception as e:
+            logger.error('failed to write command: %s', e)
+        if not self.timer:
+            self.start_timer()
+
+    def start_timer(self):
+        if self.in_flight:
+            loop = asyncio.get_running_loop()
+            due = self.in_flight[0].sent_at + self.timeout
+            self.timer = loop.call_at(due, self.on_timeout)
+        else:
+            self.timer = None
+
+    def restart_timer(self):
+        if self.timer:
+            self.timer.cancel()
+        self.start_timer()
+
+    def handle_ack(self):
+        """called when an ack was received, resolves the oldest command in flight
+        """
+        if not self.in_flight:
+            logger.warning('received ack without pending command')
+            return
+        command = self.in_flight.popleft()
+        ACK_RTT.observe(asyncio.get_running_loop().time() - command.sent_at)
+        if not command.future.done():
+            command.future.set_result(True)
+        self.restart_timer()
+        self.pump()
+
+    def on_timeout(self):
+        self.timer = None
+        if not self.in_flight:
+            return
+        command = self.in_flight.popleft()
+        ACK_TIMEOUTS.inc()
+        if command.attempts <= self.retries and not command.future.done():
+            logger.warning('message ack timed out, resending')
+            self.transmit(command)                      # goes to the back of the line, the acks come in order of sending
+        else:
+            logger.warning('message ack timed out')
+            COMMANDS_FAILED.inc()
+            if not command.future.done():
+                command.future.set_result(False)
+        if not self.timer:
+            self.start_timer()
+        self.pump()
+
+    def close(self):
+        """stop all activity, everything that is still pending is regarded as failed
+        """
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        for command in list(self.in_flight) + list(self.queue):
+            if not command.future.done():
+                command.future.set_result(False)
+        self.in_flight.clear()
+        self.queue.clear()
@@ -1,111 +1,237 @@
+import hashlib
 import json
+import logging
 import os
+import pickle
+import time
 
-def validate_ha_section(section):
-    """validates the home assistant config section
+import teletask
+from persistence import write_atomic
 
-    Args:
-        section (json object): the config part for ha
+logger = logging.getLogger('config')
+
+CONFIG_FILE = 'config.json'
+CACHE_FILE = '.config.cache'                # the last config that passed validation, with its asset index
+INDEX_VERSION = 1                           # change when the index changes, a change of the schema is picked up by CACHE_VERSION
+
+index = None                                # after load: (key, (unit, fnc, nr)) for every asset, in the same order as the assets
+
+STRING = {'type': str}
+NUMBER = {'type': (int, float)}
+INTEGER = {'type': int}
+BOOL = {'type': bool}
+COUNT = {'type': int, 'min': 1}
+TELETASK_TYPES = ('relay', 'dimmer', 'motor', 'locmood', 'timedmood', 'genmood', 'flag', 'sensor', 'process', 'regime', 'service', 'cond')
+
+
+def check_connection(section, path, errors):
+    """the teletask section needs an ip & port, either for the section or for every unit
     """
-    is_ok = True
-    if not "discovery_prefix" in section:
-        is_ok = False
-        print("missing discovery_prefix field in home_assistant section")
-    if not "client_id" in section:
-        is_ok = False
-        print("missing client_id field in home_assistant section")
-    if not "broker_host" in section:
-        is_ok = False
-        print("missing broker_host field in home_assistant section")
-    if not "device_id" in section:
-        is_ok = False
-        print("missing device_id field in home_assistant section")
-    return is_ok
-
-
-def validate_teletask_section(section):
-    """validates the teletask config part
+    units = section.get('units') or [section]
+    for i, unit in enumerate(units):
+        unit_path = path if unit is section else '{}.units[{}]'.format(path, i)
+        for name in ('ip', 'port'):
+            if not name in unit and not name in section:
+                errors.append('{}.{}: missing'.format(unit_path, name))
+
+
+SCHEMA = {
+    'type': dict,
+    'required': {
+        'home_assistant': {
+            'type': dict,
+            'required': {'discovery_prefix': STRING, 'client_id': STRING, 'broker_host': STRING, 'device_id': STRING},
+            'optional': {'refresh_interval': NUMBER, 'retain_states': BOOL, 'reconnect_delay': NUMBER, 'reconnect_max_delay': NUMBER,
+                         'discovery_cache': {'type': (str, type(None))}, 'status_topic': STRING}
+        },
+        'teletask': {
+            'type': dict,
+            'optional': {'ip': STRING, 'port': INTEGER, 'central_unit': INTEGER, 'window': INTEGER, 'ack_timeout': NUMBER, 'retries': INTEGER,
+                         'sync_window': INTEGER, 'sync_timeout': NUMBER, 'sync_rounds': INTEGER, 'reconnect_delay': NUMBER, 'reconnect_max_delay': NUMBER,
+                         'connect_timeout': NUMBER,
+                         'units': {'type': list, 'items': {'type': dict, 'required': {'central_unit': INTEGER}, 'optional': {'ip': STRING, 'port': INTEGER}}}},
+            'check': check_connection
+        },
+        'assets': {
+            'type': list,
+            'items': {
+                'type': dict,
+                'required': {'name': STRING, 'component': STRING, 'teletask_type': {'type': str, 'enum': TELETASK_TYPES}, 'central_unit': INTEGER, 'teletask_id': INTEGER},
+                'optional': {'device_class': STRING, 'unit_of_measurement': STRING, 'deadband': NUMBER, 'deadband_relative': NUMBER,
+                             'min_interval': NUMBER, 'smoothing': INTEGER, 'flush_delay': NUMBER}
+            }
+        }
+    },
+    'optional': {
+        'logging': {'type': dict, 'optional': {'level': STRING, 'levels': {'type': dict}, 'file': STRING, 'trace_frames': NUMBER}},
+        'metrics': {'type': dict, 'optional': {'interval': NUMBER, 'topic': STRING, 'http_port': INTEGER}},
+        'reload': {'type': dict, 'optional': {'watch_interval': NUMBER, 'topic': STRING}},
+        'commands': {'type': dict, 'optional': {'max_running': COUNT, 'max_queued': COUNT, 'max_queued_per_asset': COUNT}},
+        'covers': {'type': dict, 'optional': {'position_interval': NUMBER, 'calibration_max_motors': INTEGER, 'calibration_spacing': NUMBER,
+                                               'calibration_timeout': NUMBER, 'calibration_min_duration': NUMBER, 'calibration_tolerance': NUMBER,
+                                               'calibration_retries': INTEGER, 'calibration_topic': STRING}}
+    }
+}
+
+def schema_name(value):
+    return getattr(value, '__name__', repr(value))
+
+# old caches are ignored as soon as the schema or the index changes
+CACHE_VERSION = '%d-%s' % (INDEX_VERSION, hashlib.sha1(json.dumps(SCHEMA, sort_keys=True, default=schema_name).encode()).hexdigest()[:12])
+
+
+def type_name(expected):
+    if isinstance(expected, tuple):
+        return ' or '.join(item.__name__ for item in expected)
+    return expected.__name__
+
+
+def compile_schema(schema):
+    """turn the schema into a function that checks a value and collects all the errors (not only the first).
+    The schema is only walked once, checking a config only runs the resulting functions.
 
     Args:
-        section (json object): teletask specific config data
+        schema (dict): {"type": python type(s), "required": {name: schema}, "optional": {name: schema},
+            "items": schema for every item of a list, "enum": allowed values, "min": lowest allowed number, "check": func(value, path, errors)}
+    Returns:
+        func: check(value, path, errors), appends a message with the json path for every error to 'errors'
     """
-    is_ok = True
-    if not "ip" in section:
-        is_ok = False
-        print("missing ip field in teletask section")
-    if not "port" in section:
-        is_ok = False
-        print("missing port field in teletask section")
-    return is_ok
+    expected = schema.get('type')
+    allow_bool = expected is bool or (isinstance(expected, tuple) and bool in expected)       # bool is an int for python, not for json
+    checks = []
+    fields = [(name, compile_schema(item), True) for name, item in schema.get('required', {}).items()]
+    fields += [(name, compile_schema(item), False) for name, item in schema.get('optional', {}).items()]
+    if fields:
+        def check_fields(value, path, errors):
+            for name, check, is_required in fields:
+                if name in value:
+                    check(value[name], '{}.{}'.format(path, name), errors)
+                elif is_required:
+                    errors.append('{}.{}: missing'.format(path, name))
+        checks.append(check_fields)
+    if 'items' in schema:
+        check_item = compile_schema(schema['items'])
+        def check_items(value, path, errors):
+            for i, item in enumerate(value):
+                check_item(item, '{}[{}]'.format(path, i), errors)
+        checks.append(check_items)
+    if 'enum' in schema:
+        allowed = frozenset(schema['enum'])
+        def check_enum(value, path, errors):
+            if value.lower() not in allowed:
+                errors.append('{}: "{}" is not one of {}'.format(path, value, ', '.join(schema['enum'])))
+        checks.append(check_enum)
+    if 'min' in schema:
+        minimum = schema['min']
+        def check_min(value, path, errors):
+            if value < minimum:
+                errors.append('{}: {} is less than {}'.format(path, value, minimum))
+        checks.append(check_min)
+    if 'check' in schema:
+        checks.append(schema['check'])
 
+    def check(value, path, errors):
+        if expected and (not isinstance(value, expected) or (isinstance(value, bool) and not allow_bool)):
+            errors.append('{}: expected {}, found {}'.format(path, type_name(expected), type(value).__name__))
+            return
+        for item in checks:
+            item(value, path, errors)
+    return check
 
-def validate_assets_section(section):
-    """validates the assets config part
 
-    Args:
-        section (json array): assets specific config data
+check_config = compile_schema(SCHEMA)
+
+
+def get_errors(config):
+    """all the problems in the config
+    Returns:
+        list: messages that start with the json path of the problem, empty when the config is valid
     """
-    is_ok = True
-    count = 1
-    for asset in section:
-        name = '{}'.format(count)
-        if not "name" in asset:
-            is_ok = False
-            print("missing name field in asset section, {}".format(name))
-        else:
-            name = '{}.{}'.format(count, asset['name'])
-        if not "component" in asset:
-            is_ok = False
-            print("missing component field in asset section, {}".format(name))
-        if not "teletask_type" in asset:
-            is_ok = False
-            print("missing teletask_type field in asset section, {}".format(name))
-        if not "central_unit" in asset:
-            is_ok = False
-            print("missing central_unit field in asset section, {}".format(name))
-        if not "teletask_id" in asset:
-            is_ok = False
-            print("missing teletask_id field in asset section, {}".format(name))
-        count += 1
-    return is_ok
+    errors = []
+    check_config(config, '$', errors)
+    return errors
 
 
 def validate_config(config):
     """checks the json config to see if all the required fields
-        are present
+        are present and have the correct type. All the errors are logged.
     Args:
         config (json object): the config data
     """
-    is_ok = True
-    if not "home_assistant" in config:
-        is_ok = False
-        print("missing home_assistant section")
-    else: 
-        is_ok = validate_ha_section(config['home_assistant'])
-    if not "teletask" in config:
-        is_ok = False
-        print("missing teletask section")
-    else: 
-        is_ok &= validate_teletask_section(config['teletask'])
-    if not "assets" in config:
-        is_ok = False
-        print("missing assets section")
-    else: 
-        is_ok &= validate_assets_section(config['assets'])
-    return is_ok
+    errors = get_errors(config)
+    for error in errors:
+        logger.error("invalid config: %s", error)
+    return not errors
 
 
-def load():
-    """loads the config
+def build_index(assets):
+    """the keys & teletask ids of the assets, so they don't need to be calculated again while loading
+    Returns:
+        list: (key, (unit, fnc, nr)) for every asset
     """
-    print("loading config")
-    if not os.path.exists('config.json'):
-        print("no config found")
+    return [(teletask.build_key_from_asset(asset), teletask.get_id(asset)) for asset in assets]
+
+
+def load_cache(stat, digest=None):
+    """the cached config, if it was made from the same config file. The file is the same when it has the same
+    modification time & size, or (when given) the same hash.
+    Returns:
+        dict: the cache or None
+    """
+    if not os.path.exists(CACHE_FILE):
+        return None
+    try:
+        with open(CACHE_FILE, 'rb') as file:
+            cache = pickle.load(file)
+    except Exception as e:
+        logger.warning("invalid config cache, ignoring it: %s", e)
         return None
-    with open('config.json', encoding='utf-8') as file:
-        data = json.load(file)
-        print("found config {}".format(json.dumps(data)))
-        if not validate_config(data):
-            return None
-        return data
+    if cache.get('version') != CACHE_VERSION:
+        return None
+    if (cache['mtime_ns'], cache['size']) == (stat.st_mtime_ns, stat.st_size) or (digest and cache['sha1'] == digest):
+        return cache
+    return None
+
+
+def save_cache(cache):
+    try:
+        write_atomic(CACHE_FILE, pickle.dumps(cache, pickle.HIGHEST_PROTOCOL))
+    except OSError as e:
+        logger.warning("failed to save the config cache: %s", e)
+
 
+def load():
+    """loads the config. When the file didn't change since the previous start, the validated config & asset index
+    are taken from the cache, without parsing & validating again.
+    """
+    global index
+    logger.info("loading config")
+    if not os.path.exists(CONFIG_FILE):
+        logger.error("no config found")
+        return None
+    start = time.perf_counter()
+    stat = os.stat(CONFIG_FILE)
+    cache = load_cache(stat)
+    if not cache:
+        with open(CONFIG_FILE, 'rb') as file:
+            content = file.read()
+        digest = hashlib.sha1(content).hexdigest()
+        cache = load_cache(stat, digest)                   # only touched, not changed
+        if not cache:
+            try:
+                data = json.loads(content.decode('utf-8'))
+            except ValueError as e:
+                logger.error("config.json is not valid json: %s", e)
+                return None
+            if not validate_config(data):
+                return None
+            cache = {'version': CACHE_VERSION, 'sha1': digest, 'config': data, 'index': build_index(data['assets'])}
+        cache['mtime_ns'] = stat.st_mtime_ns
+        cache['size'] = stat.st_size
+        save_cache(cache)
+        logger.info("config validated in %.1f ms", (time.perf_counter() - start) * 1000)
+    else:
+        logger.info("config loaded from cache in %.1f ms", (time.perf_counter() - start) * 1000)
+    logger.debug("found config %s", cache['config'])
+    index = cache['index']
+    return cache['config']
@@ -0,0 +1,95 @@
+"""a stand-in for the gmqtt client, so the home assistant side of the bridge can be run and measured without a broker.
+It has the parts of the gmqtt Client interface that home_assistant uses, records every publish with a
+timestamp and can deliver messages to the subscribed topics like the broker would.
+usage: home_assistant.MQTTClient = FakeMQTTClient
+"""
+import time
+from collections import namedtuple
+
+Subscription = namedtuple('Subscription', ['topic', 'qos'])
+Publish = namedtuple('Publish', ['topic', 'payload', 'qos', 'retain', 'at'])
+
+
+def topic_matches(pattern, topic):
+    """check if the topic matches the subscription pattern (with + and # wildcards)
+    """
+    pattern_parts = pattern.split('/')
+    topic_parts = topic.split('/')
+    for i, part in enumerate(pattern_parts):
+        if part == '#':
+            return True
+        if i >= len(topic_parts) or (part != '+' and part != topic_parts[i]):
+            return False
+    return len(pattern_parts) == len(topic_parts)
+
+
+class FakeMQTTClient:
+
+    def __init__(self, client_id=None):
+        self.client_id = client_id
+        self.on_connect = None
+        self.on_message = None
+        self.on_disconnect = None
+        self.on_subscribe = None
+        self.publishes = []                 # list of Publish
+        self.subscriptions = []             # list of Subscription
+        self.by_mid = {}                    # mid -> list of Subscription
+        self.retained = {}                  # topic -> payload, like the broker keeps them
+        self.is_connected = False
+        self.last_mid = 0
+        self.reconnect_delay = 6
+
+    def drop(self):
+        """simulate a lost connection"""
+        self.is_connected = False
+        if self.on_disconnect:
+            self.on_disconnect(self, None)
+
+    def restore(self):
+        """simulate a reconnect"""
+        self.is_connected = True
+        if self.on_connect:
+            self.on_connect(self, 0, 0, None)
+
+    async def connect(self, host, *args, **kwargs):
+        self.is_connected = True
+        if self.on_connect:
+            self.on_connect(self, 0, 0, None)
+
+    async def disconnect(self, *args, **kwargs):
+        self.is_connected = False
+        if self.on_disconnect:
+            self.on_disconnect(self, None)
+
+    def subscribe(self, topic, qos=0, **kwargs):
+        self.last_mid += 1
+        subscription = Subscription(topic, qos)
+        self.subscriptions.append(subscription)
+        self.by_mid[self.last_mid] = [subscription]
+        if self.on_subscribe:
+            self.on_subscribe(self, self.last_mid, (qos,), None)
+        return self.last_mid
+
+    def get_subscriptions_by_mid(self, mid):
+        return self.by_mid.get(mid, [])
+
+    def publish(self, topic, payload=None, qos=0, retain=False, **kwargs):
+        self.publishes.append(Publish(topic, payload, qos, retain, time.perf_counter()))
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)            # empty retained message removes it
+
+    def deliver(self, topic, payload, qos=0):
+        """simulate a message from the broker, it's only delivered when one of the subscriptions matches
+        Args:
+            topic (string): the topic of the message
+            payload (bytes): the content
+        Returns:
+            bool: True if the message was delivered
+        """
+        if not self.on_message or not any(topic_matches(sub.topic, topic) for sub in self.subscriptions):
+            return False
+        self.on_message(self, topic, payload, qos, None)
+        return True
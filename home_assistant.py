@@ -1,62 +1,158 @@
 import asyncio
+import hashlib
 import json
+import logging
+import os
+import time
 
+import metrics
 import teletask
+from backoff import Backoff
+from persistence import JsonStore
+from sensor_filter import SensorFilter, has_filter
 
-from gmqtt import Client as MQTTClient
-from gmqtt import constants as MQTTConst
+logger = logging.getLogger('home_assistant')
 
+MQTTClient = None                                       # the gmqtt client class, only imported when starting: slow to import on a pi
 client = None
 discovery_prefix = 'homeassistant'
 node_id = "teletask_1"                                # the id of the teletask device for mqtt topics
-on_actuator = None                                      # callback that handles actuator messages for teletask
+on_actuator = None                                      # callback(key, asset, kind, value) for the commands of the assets, it must not block
 main_loop = None                                        # async loop
 is_connected = False
 wait_for_connected = None
+has_connected = False                                   # true after the first connect, the next ones are reconnects
+is_stopping = False
+supervisor_task = None                                  # stretches the reconnect delay of gmqtt while the connection is down
+reconnect_delay = 1.0                                   # first delay before reconnecting, doubles for every failed attempt
+reconnect_max_delay = 60.0
+subscriptions = []                                      # the topics we subscribed to, so they can be renewed after a reconnect
+pending_states = {}                                     # topic -> payload, states that couldn't be published while disconnected
+
+last_published = {}                                     # topic -> (payload, published_at), so we don't send the same state multiple times
+refresh_interval = 0                                    # nr of seconds after which an unchanged state is published again, 0 = never
+retain_states = False                                   # when true, states are published as retained messages
+discovery_cache = {}                                    # config topic -> hash of the discovery payload that was published (retained) on it
+discovery_store = None                                  # writes the discovery cache to disk, None = no cache
+status_topic = None                                     # home assistant publishes 'online' on this topic when it (re)starts
+loaded_items = []                                       # the assets that were published for discovery, so they can be republished
+command_handlers = {}                                   # topic -> callback(payload) for the commands of the bridge itself (not for an asset)
+router = {}                                             # command topic of an asset -> handler(payload), built with the discovery configs
+
+PUBLISHES = metrics.counter('home_assistant.publishes')
+PUBLISHES_SKIPPED = metrics.counter('home_assistant.publishes_skipped')     # state didn't change
+PUBLISH_TIME = metrics.histogram('home_assistant.publish')
+DISCONNECTS = metrics.counter('home_assistant.disconnects')
+DISCOVERY_PUBLISHED = metrics.counter('home_assistant.discovery_published')
+DISCOVERY_SKIPPED = metrics.counter('home_assistant.discovery_skipped')     # config didn't change since the previous run
+REPLAYS = metrics.counter('home_assistant.replays')                         # home assistant restarted, all the states were published again
+UNKNOWN_TOPICS = metrics.counter('home_assistant.unknown_topics')           # messages for a topic that isn't routed
+metrics.gauge('home_assistant.connected', lambda: is_connected)
 
 
 def on_connect(client, flags, rc, properties):
-    global is_connected
-    print('Connected')
+    global is_connected, has_connected
+    logger.info('Connected')
     is_connected = True
+    if has_connected:
+        resync()
+    has_connected = True
     if wait_for_connected:                              # could be that other part is still waiting for the connection to be established before continuing
         wait_for_connected.set()
 
 def on_message(client, topic, payload, qos, properties):
-    print('RECV MSG:', payload)
-    if not on_actuator:
+    handler = router.get(topic)
+    if handler:                                         # the command of an asset, most common, so first
+        if on_actuator:
+            handler(payload)
         return
-    payload = payload.decode()
-    topic_parts = topic.split('/')
-    teletask_parts = topic_parts[3].split('_')
-    if len(teletask_parts) < 3:
-        print("Invalid teletask part: " + topic_parts[3])
-    else:
-        main_loop.create_task(on_actuator(teletask_parts[0], teletask_parts[1], teletask_parts[2], payload))
+    logger.debug('RECV MSG: %s %s', topic, payload)
+    if topic in command_handlers:
+        command_handlers[topic](payload)
+        return
+    if topic == status_topic:
+        if payload == b'online' and not (properties and properties.get('retain')):  # a retained 'online' is an old birth message, we got it because we subscribed
+            on_birth()
+        return
+    UNKNOWN_TOPICS.inc()
+    logger.debug('no route for topic: %s', topic)
 
 
 def on_disconnect(client, packet, exc=None):
-    print('Disconnected')
-    global is_connected
+    global is_connected, supervisor_task
     is_connected = False
+    if is_stopping:
+        logger.info('Disconnected')
+        return
+    logger.warning('Disconnected')
+    DISCONNECTS.inc()
+    if not supervisor_task or supervisor_task.done():
+        supervisor_task = main_loop.create_task(supervise_reconnect())
+
+
+async def supervise_reconnect():
+    """gmqtt reconnects on it's own, but with a fixed delay. While the connection stays down, the delay is
+    stretched with a jittered exponential backoff so we don't hammer the broker.
+    """
+    backoff = Backoff(reconnect_delay, reconnect_max_delay)
+    while client and not is_connected and not is_stopping:
+        delay = backoff.next()
+        client.reconnect_delay = delay
+        await asyncio.sleep(delay)
+
+
+def resync():
+    """the connection is back: renew the subscriptions and publish the states that changed while disconnected
+    """
+    logger.info('connection restored, %d states to resync', len(pending_states))
+    for topic in subscriptions:
+        client.subscribe(topic)
+    to_publish = list(pending_states.items())
+    pending_states.clear()
+    for topic, payload in to_publish:
+        publish_state(topic, payload)                   # only publishes when it differs from what was published before
+
+
+def on_birth():
+    """home assistant (re)started and forgot everything: publish the discovery configs and the last known
+    state of every asset again, from what was published before, so teletask doesn't need to be queried.
+    """
+    if not loaded_items:                                # still starting up, everything gets published anyway
+        return
+    logger.info('home assistant is online, publishing discovery & %d states', len(last_published))
+    publish_discovery(loaded_items, True)
+    now = time.monotonic()
+    for topic, (payload, published_at) in list(last_published.items()):
+        client.publish(topic, payload, qos=0, retain=retain_states)
+        last_published[topic] = (payload, now)
+    REPLAYS.inc()
 
 
 def on_subscribe(client, mid, qos, properties):
     subscriptions = client.get_subscriptions_by_mid(mid)
     for subscription, granted_qos in zip(subscriptions, qos):
         if granted_qos == 0:
-            print('subscribed to topic: {}'.format(subscription.topic))
+            logger.info('subscribed to topic: %s', subscription.topic)
         else:
-            print('failed to subscribe to topic: {}'.format(subscription.topic))
+            logger.error('failed to subscribe to topic: %s', subscription.topic)
 
 async def start(config, callback, loop):
-    global client, discovery_prefix, on_actuator, node_id, main_loop
-    print("starting home-assistant connection")
+    global client, discovery_prefix, on_actuator, node_id, main_loop, refresh_interval, retain_states, reconnect_delay, reconnect_max_delay, is_stopping, status_topic, MQTTClient
+    logger.info("starting home-assistant connection")
     on_actuator = callback
     main_loop = loop
     discovery_prefix = config['discovery_prefix']
     node_id = config['device_id']
+    refresh_interval = config.get('refresh_interval', refresh_interval)
+    retain_states = config.get('retain_states', retain_states)
+    reconnect_delay = config.get('reconnect_delay', reconnect_delay)
+    reconnect_max_delay = config.get('reconnect_max_delay', reconnect_max_delay)
+    is_stopping = False
+    load_discovery_cache(config.get('discovery_cache', 'discovery.json'))
+    status_topic = config.get('status_topic', '{}/status'.format(discovery_prefix))
 
+    if not MQTTClient:
+        from gmqtt import Client as MQTTClient
     client = MQTTClient(config['client_id'])
 
     client.on_connect = on_connect
@@ -68,7 +164,7 @@ async def start(config, callback, loop):
         await client.connect(config['broker_host'])
         return True
     except Exception as e:
-        print('{}'.format(e))
+        logger.error('failed to connect: %s', e)
         return False
 
 
@@ -76,10 +172,33 @@ async def stop():
     """
     close the connection
     """
-    global client
+    global client, is_stopping
+    is_stopping = True
     if client:
         await client.disconnect()
         client = None
+    if discovery_store:
+        await discovery_store.flush()
+
+
+def load_discovery_cache(path):
+    """load the hashes of the discovery configs that were published by the previous run
+
+    Args:
+        path (string): the file with the cache, empty = don't use a cache
+    """
+    global discovery_cache, discovery_store
+    discovery_cache = {}
+    discovery_store = None
+    if not path:
+        return
+    discovery_store = JsonStore(path, lambda: discovery_cache, 2.0, 'home_assistant.discovery')
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as file:
+                discovery_cache = json.load(file)
+        except ValueError as e:
+            logger.warning('invalid discovery cache %s, publishing all the configs: %s', path, e)
 
 
 def build_asset_def(base_topic, asset, key, is_first):
@@ -114,12 +233,67 @@ def build_asset_def(base_topic, asset, key, is_first):
             payload['set_position_topic'] = '~/setpos'
     return payload
 
-def load_asset(asset, is_first):
+def build_base_topic(asset, key):
+    return '{}/{}/{}/{}'.format(discovery_prefix, asset['component'], node_id, key)
+
+def build_command_handler(key, asset, kind):
+    """the handler for 1 command topic, bound to the asset and the kind of command
+    """
+    def handle(payload):
+        on_actuator(key, asset, kind, payload.decode())
+    return handle
+
+def add_command_routes(new_router, asset, key, base_topic):
+    """map the command topics of the asset (the same ones as in its discovery config) to their handlers
+    """
+    if asset['component'] == 'button':
+        kinds = ['exec']
+    else:
+        kinds = []
+        if asset['teletask_type'] not in ['flag', 'sensor']:
+            kinds.append('set')
+        if asset['teletask_type'] == 'dimmer':
+            kinds.append('setbri')
+        if asset['component'] == 'cover':
+            kinds.append('setpos')
+    for kind in kinds:
+        new_router['{}/{}'.format(base_topic, kind)] = build_command_handler(key, asset, kind)
+
+def load_asset(asset, is_first, published, force=False, new_router=None):
+    """publish the discovery config of the asset (retained), unless the same config was already published before
+
+    Args:
+        asset (object): the asset
+        is_first (bool): the first asset also describes the device
+        published (set): the config topics of the current assets, the topic is added to it
+        force (bool): also publish when the config didn't change
+        new_router (dict): the command topics of the asset are added to it
+    """
     key = teletask.build_key_from_asset(asset)
-    base_topic = '{}/{}/{}/{}'.format(discovery_prefix, asset['component'], node_id, key)
+    base_topic = build_base_topic(asset, key)
+    if new_router is not None:
+        add_command_routes(new_router, asset, key, base_topic)
     config_topic = '{}/config'.format(base_topic)
-    payload = build_asset_def(base_topic, asset, key, is_first)
-    client.publish(config_topic, bytearray(json.dumps(payload), 'utf-8'), qos=1)
+    payload = json.dumps(build_asset_def(base_topic, asset, key, is_first), sort_keys=True).encode()
+    published.add(config_topic)
+    digest = hashlib.sha1(payload).hexdigest()
+    if not force and discovery_cache.get(config_topic) == digest:
+        DISCOVERY_SKIPPED.inc()
+        return
+    client.publish(config_topic, payload, qos=1, retain=True)
+    discovery_cache[config_topic] = digest
+    DISCOVERY_PUBLISHED.inc()
+
+def remove_deleted_assets(published):
+    """remove the discovery configs of the assets that were published before but are no longer in the config
+
+    Args:
+        published (set): the config topics of the current assets
+    """
+    for config_topic in [topic for topic in discovery_cache if topic not in published]:
+        logger.info('removing deleted asset %s', config_topic)
+        client.publish(config_topic, b'', qos=1, retain=True)        # empty retained config: home assistant removes the entity
+        del discovery_cache[config_topic]
 
 async def load_assets(items):
     """
@@ -135,85 +309,207 @@ async def load_assets(items):
         wait_for_connected = asyncio.Event()                    # let the event handler know we want to get warned
         await wait_for_connected.wait()
         wait_for_connected = None
-    print("sending discovery data to home assistant")
+    update_assets(items)
+
+
+def update_assets(items):
+    """publish the discovery configs that are new or changed, remove the ones of deleted assets and
+    subscribe to the commands (used at startup and when the config is reloaded)
+    """
+    global loaded_items
+    has_covers = publish_discovery(items, build_router=True)
+    loaded_items = items
+    if has_covers:
+        subscribe('{}/+/{}/+/exec'.format(discovery_prefix, node_id))
+    subscribe(status_topic)
+    # need to get messages sent to this device for all actuators
+    subscribe('{}/+/{}/+/set'.format(discovery_prefix, node_id))
+    subscribe('{}/+/{}/+/setbri'.format(discovery_prefix, node_id))
+    if has_covers:
+        subscribe('{}/+/{}/+/setpos'.format(discovery_prefix, node_id))
+
+
+def publish_discovery(items, force=False, build_router=False):
+    """publish the discovery configs of the assets and the calibrate buttons (for covers)
+
+    Args:
+        items (list): the assets
+        force (bool): also publish the configs that didn't change
+        build_router (bool): also map the command topics of the assets to their handlers
+    Returns:
+        bool: True if there are covers
+    """
+    global router
+    logger.info("sending discovery data to home assistant")
     has_covers = False
     is_first = True
+    published = set()
+    new_router = {} if build_router else None
+    published_before, skipped_before = DISCOVERY_PUBLISHED.value, DISCOVERY_SKIPPED.value
     for asset in items:
-        load_asset(asset, is_first)
+        load_asset(asset, is_first, published, force, new_router)
         is_first = False
         is_cover = asset['component'] == 'cover'
         if is_cover:
             asset = {"name": "calibrate cover {}".format(asset['name']), "component": "button", "teletask_type": "calibrate", "central_unit": 1, "teletask_id": asset['teletask_id']}    
-            load_asset(asset, is_first)
+            load_asset(asset, is_first, published, force, new_router)
         has_covers = has_covers or is_cover
     if has_covers:
         asset = {"name": "calibrate covers", "component": "button", "teletask_type": "calibrate", "central_unit": 1, "teletask_id": -1}
-        load_asset(asset, is_first)
-        client.subscribe('{}/+/{}/+/exec'.format(discovery_prefix, node_id))
-    # need to get messages sent to this device for all actuators
-    client.subscribe('{}/+/{}/+/set'.format(discovery_prefix, node_id))
-    client.subscribe('{}/+/{}/+/setbri'.format(discovery_prefix, node_id))
-    if has_covers:
-        client.subscribe('{}/+/{}/+/setpos'.format(discovery_prefix, node_id))
+        load_asset(asset, is_first, published, force, new_router)
+    remove_deleted_assets(published)
+    if build_router:
+        router = new_router
+    logger.info("discovery: %s configs published, %s unchanged", DISCOVERY_PUBLISHED.value - published_before, DISCOVERY_SKIPPED.value - skipped_before)
+    if discovery_store:
+        discovery_store.mark_dirty()
+    return has_covers
+
 
+def subscribe(topic):
+    if topic not in subscriptions:                      # already subscribed topics are renewed by resync after a reconnect
+        subscriptions.append(topic)
+        client.subscribe(topic)
 
-def get_value(asset, value, as_dimmer=False):
-    """convert the value to something home assistant can work with
+
+def subscribe_command(topic, callback):
+    """subscribe to a command for the bridge itself
+
+    Args:
+        topic (string): the topic of the command
+        callback (func): called with the payload of every message on the topic
     """
+    command_handlers[topic] = callback
+    subscribe(topic)
+
+
+ON = b'ON'
+OFF = b'OFF'
+STOPPED = b'stopped'
+CLOSING = b'closing'
+OPENING = b'opening'
+
+def encode_on_off(values):
+    return OFF if values[0] == 0 else ON                # need to compare the value, not the array
+
+def encode_cover(values):
+    if values[1] == 0:
+        return STOPPED
+    elif values[0] == 2:
+        return CLOSING
+    return OPENING
+
+def encode_sensor(values):
+    """the measured value (temperature), convert it to a string for easy sending
+    """
+    return '{}'.format(values[0]).encode()
+
+def encode_raw(values):
+    return values                                       # return the full array cause mqtt publish wants a byte array
+
+
+class Route:
+    """everything that is needed to publish the state of an asset, prepared once when the assets
+    are loaded so that the event path doesn't need to build keys, topics or select converters.
+    """
+    __slots__ = ('asset', 'key', 'is_cover', 'state_topic', 'brightness_topic', 'position_topic', 'encode', 'filter')
+
+    def __init__(self, asset, key, is_cover, state_topic, brightness_topic, position_topic, encode):
+        self.asset = asset
+        self.key = key
+        self.is_cover = is_cover
+        self.state_topic = state_topic
+        self.brightness_topic = brightness_topic        # only for dimmers
+        self.position_topic = position_topic            # only for covers
+        self.encode = encode                            # converts the teletask values into something home assistant can work with
+        self.filter = None                              # SensorFilter for sensors that shouldn't publish every value
+
+
+def build_route(asset, key=None):
+    """build the route that is used to publish the state of the asset
+    Args:
+        asset (object): the asset definition
+        key (string): the key of the asset, when already known
+    Returns:
+        Route: the prepared route
+    """
+    if not key:
+        key = teletask.build_key_from_asset(asset)
+    base_topic = build_base_topic(asset, key)
     component = asset['component']
-    result = None
     if component == 'light':
-        if not as_dimmer:                               # when as dimmer, always use the actual value
-            if value[0] == 0:                           # need to compare the value, not the array
-                result = 'OFF'
-            else:
-                result = 'ON'
+        encode = encode_on_off
     elif component == 'cover':
-        # print("values: {}".format(value))
-        if value[1] == 0:
-            result = 'stopped'
-        elif value[0] == 2:
-            result = 'closing'
-        else:
-            result = 'opening'
-    elif component == 'sensor':                     # a single numeric value (temperature), convert it to a string for easy sending?
-        result = '{}'.format(value)
-    if result == None:
-        result = value                              # return the full array cause mqtt publish wants a byte array
+        encode = encode_cover
+    elif component == 'sensor':
+        encode = encode_sensor
     else:
-        result = bytearray(result, 'utf-8')
-    return result
+        encode = encode_raw
+    brightness_topic = base_topic + '/statebri' if asset['teletask_type'] == 'dimmer' else None
+    position_topic = base_topic + '/pos' if component == 'cover' else None
+    route = Route(asset, key, component == 'cover', base_topic + '/state', brightness_topic, position_topic, encode)
+    if asset['teletask_type'] == 'sensor' and has_filter(asset):
+        route.filter = SensorFilter(asset, lambda value: send(route, (value,)))
+    return route
+
+
+def forget_route(route):
+    """the asset was removed or changed, the states of its old topics shouldn't be published again (resync, birth)
+    """
+    for topic in (route.state_topic, route.brightness_topic, route.position_topic):
+        last_published.pop(topic, None)
+        pending_states.pop(topic, None)
+
+
+def publish_state(topic, payload):
+    """publish the payload on the topic, unless the same payload was already published there
+    (and the refresh interval hasn't passed yet)
+    Returns:
+        bool: True if the payload was published
+    """
+    if not is_connected:                                # keep the latest, it gets published when the connection is back
+        pending_states[topic] = payload
+        return False
+    now = time.monotonic()
+    previous = last_published.get(topic)
+    if previous and previous[0] == payload and (not refresh_interval or now - previous[1] < refresh_interval):
+        PUBLISHES_SKIPPED.inc()
+        return False
+    last_published[topic] = (payload, now)
+    logger.debug("publishing to: %s, value: %s", topic, payload)
+    client.publish(topic, payload, qos=0, retain=retain_states)
+    PUBLISHES.inc()
+    PUBLISH_TIME.observe(time.monotonic() - now)
+    return True
 
-def send(asset, value):
+def send(route, value):
+    """publish the state of an asset
+    Args:
+        route (Route): the route of the asset
+        value (list or number): the values reported by teletask
+    """
     if not client:
         raise Exception("not connected")
-    key = teletask.build_key_from_asset(asset)
-    if asset['teletask_type'] == 'dimmer':
-        to_send = get_value(asset, value, False)
-        topic = '{}/{}/{}/{}/state'.format(discovery_prefix, asset['component'], node_id, key)
-        print("publishing to: {}, value: {}".format(topic, to_send))
-        client.publish(topic, to_send, qos=0)
-
-        to_send = get_value(asset, value, True)
-        topic = '{}/{}/{}/{}/statebri'.format(discovery_prefix, asset['component'], node_id, key)
-        print("publishing to: {}, value: {}".format(topic, to_send))
-        client.publish(topic, to_send, qos=0)
-    else:
-        to_send = get_value(asset, value)
-        topic = '{}/{}/{}/{}/state'.format(discovery_prefix, asset['component'], node_id, key)
-        print("publishing to: {}, value: {}".format(topic, to_send))
-        client.publish(topic, to_send, qos=0)
+    publish_state(route.state_topic, route.encode(value))
+    if route.brightness_topic:                          # dimmers also report the actual value
+        publish_state(route.brightness_topic, value)
 
-def send_cover_pos(asset, value):
+def send_cover_pos(route, value):
     """special function to send the current position of the cover to this specific topic.
 
     Args:
-        asset (object): the asset to send the value for
+        route (Route): the route of the cover to send the value for
         value (integer): position of the cover
     """
     if not client:
         raise Exception("not connected")
-    key = teletask.build_key_from_asset(asset)
-    topic = '{}/{}/{}/{}/pos'.format(discovery_prefix, asset['component'], node_id, key)
-    print("publishing to: {}, value: {}".format(topic, value))
-    client.publish(topic, value, qos=0)
\ No newline at end of file
+    publish_state(route.position_topic, '{}'.format(value).encode())        # position can be a number or a string, make certain that we compare the same thing
+
+def publish_diagnostics(topic, payload):
+    """publish the metrics of the bridge
+    Args:
+        topic (string): where to publish
+        payload (bytes): json data
+    """
+    if client:
+        client.publish(topic, payload, qos=0)
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger('main')
+
+
+class KeyedExecutor:
+    """runs async jobs: the jobs with the same key strictly one after the other, in the order they were submitted,
+    jobs with different keys at the same time, with at most 'max_running' jobs running at once.
+    The nr of jobs that wait is limited (in total & per key), so a burst of jobs can't pile up endlessly.
+    """
+
+    def __init__(self, max_running=8, max_queued=200, max_queued_per_key=20, name='executor'):
+        """
+        Args:
+            max_running (number): max nr of jobs that run at the same time
+            max_queued (number): max nr of jobs that wait, when full, new jobs are dropped
+            max_queued_per_key (number): max nr of jobs that wait for 1 key, when full, the oldest one is dropped
+            name (string): name used for the metrics
+        """
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.max_queued_per_key = max_queued_per_key
+        self.name = name
+        self.queues = {}                        # key -> deque of (func, args, submitted_at) that didn't start yet, only for keys with a job running or waiting
+        self.busy = set()                       # keys that have a job running
+        self.ready = deque()                    # keys that have a job that can start as soon as there is room
+        self.tasks = set()                      # the jobs that are running
+        self.queued = 0
+        self.dropped = metrics.counter(name + '.dropped')
+        self.replaced = metrics.counter(name + '.replaced')
+        self.wait_time = metrics.histogram(name + '.wait')
+        metrics.gauge(name + '.running', lambda: len(self.tasks))
+        metrics.gauge(name + '.queued', lambda: self.queued)
+
+    def submit(self, key, func, *args, replace=False):
+        """run func(*args) after the jobs that were already submitted for the key
+
+        Args:
+            key (string): jobs with the same key never run at the same time
+            func (async func): the job, only called when it's the job's turn
+            replace (bool): latest wins: the job replaces the last job of the key that didn't start yet (if any)
+        Returns:
+            bool: False if the job was dropped because the queue is full
+        """
+        queue = self.queues.get(key)
+        is_idle = not queue and key not in self.busy               # not running & not in ready yet
+        if queue is None:
+            queue = self.queues[key] = deque()
+        elif replace and queue:
+            queue[-1] = (func, args, queue[-1][2])
+            self.replaced.inc()
+            return True
+        if self.queued >= self.max_queued:
+            self.drop('%d jobs waiting, dropped the new job for %s', self.queued, key)
+            if not queue and key not in self.busy:
+                del self.queues[key]
+            return False
+        if len(queue) >= self.max_queued_per_key:
+            queue.popleft()                                         # the newest job is the most relevant one
+            self.queued -= 1
+            self.drop('%d jobs waiting for %s, dropped the oldest one', len(queue) + 1, key)
+        queue.append((func, args, time.perf_counter()))
+        self.queued += 1
+        if is_idle:
+            self.ready.append(key)
+            self.start_next()
+        return True
+
+    def drop(self, message, *args):
+        """count the dropped job, during a storm only every 100th drop is logged
+        """
+        self.dropped.inc()
+        if self.dropped.value % 100 == 1:
+            logger.warning('%s: ' + message + ' (%d dropped in total)', self.name, *args, self.dropped.value)
+
+    def start_next(self):
+        while self.ready and len(self.tasks) < self.max_running:
+            key = self.ready.popleft()
+            func, args, submitted_at = self.queues[key].popleft()
+            self.queued -= 1
+            self.wait_time.observe(time.perf_counter() - submitted_at)
+            self.busy.add(key)
+            task = asyncio.ensure_future(self.run(key, func, args))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run(self, key, func, args):
+        try:
+            await func(*args)
+        except Exception as e:
+            logger.exception('%s: job for %s failed: %s', self.name, key, e)
+        finally:
+            self.busy.discard(key)
+            if self.queues[key]:
+                self.ready.append(key)
+            else:
+                del self.queues[key]
+            self.tasks.discard(asyncio.current_task())
+            self.start_next()
+
+    async def stop(self):
+        """drop the jobs that didn't start yet and wait for the running ones
+        """
+        self.queues = {key: deque() for key in self.busy}
+        self.ready.clear()
+        self.queued = 0
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
@@ -0,0 +1,90 @@
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+listener = None                             # QueueListener that writes the log records from a background thread
+handler = None                              # the handler that does the actual writing (console or file)
+
+
+def setup():
+    """route all logging through a queue so that the writing (to the console or file) is done on a
+    separate thread instead of the event loop. Until configure is called, everything from INFO is logged.
+    """
+    global listener, handler
+    if listener:
+        return
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+
+
+def configure(config):
+    """apply the logging section of the config
+    Args:
+        config (json object): {"level": "INFO", "levels": {"teletask": "DEBUG", ...}, "file": "path", "trace_frames": number}
+    """
+    global handler
+    if not config:
+        return
+    logging.getLogger().setLevel(config.get('level', 'INFO').upper())
+    for name, level in config.get('levels', {}).items():
+        logging.getLogger(name).setLevel(level.upper())
+    if 'file' in config:
+        new_handler = logging.FileHandler(config['file'], encoding='utf-8')
+        new_handler.setFormatter(logging.Formatter(FORMAT))
+        listener.handlers = (new_handler,)
+        handler.close()
+        handler = new_handler
+    FrameTracer.max_per_sec = config.get('trace_frames', FrameTracer.max_per_sec)
+
+
+def stop():
+    """write everything that is still in the queue
+    """
+    global listener
+    if listener:
+        listener.stop()
+        listener = None
+        handler.close()
+
+
+class FrameTracer:
+    """logs the raw teletask frames at DEBUG level, limited to 'max_per_sec' frames per second
+    (0 = no limit). When DEBUG is not enabled for the logger, 'enabled' is False and callers skip
+    the trace without building any message.
+    """
+    max_per_sec = 0
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.window_start = 0
+        self.count = 0
+        self.dropped = 0
+
+    @property
+    def enabled(self):
+        return self.logger.isEnabledFor(logging.DEBUG)
+
+    def trace(self, direction, frame):
+        if self.max_per_sec:
+            now = time.monotonic()
+            if now - self.window_start >= 1:
+                if self.dropped:
+                    self.logger.debug('%d frames not traced (rate limit)', self.dropped)
+                self.window_start = now
+                self.count = 0
+                self.dropped = 0
+            if self.count >= self.max_per_sec:
+                self.dropped += 1
+                return
+            self.count += 1
+        self.logger.debug('%s: %s', direction, bytes(frame).hex(' '))
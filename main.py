@@ -1,89 +1,276 @@
 import asyncio
+import json
+import logging
+import os
 import signal
+import time
 import home_assistant as HA
 import teletask
 import config as Config
 import roller_shutters as RS
+import logger as Log
+import metrics
 import platform
+from keyed_executor import KeyedExecutor
 
 STOP = asyncio.Event()
-assets_dict = {}                            # provides a mapping between teletask-ids and loaded assets. allows us to see if we are really monitoring an event or not (teletask just sends everything)
+logger = logging.getLogger('main')
+assets_dict = {}                            # provides a mapping between asset keys and the routes of the loaded assets (used for the commands from home assistant)
+routes = {}                                 # (unit, fnc, nr) -> route, allows us to see if we are really monitoring an event or not (teletask just sends everything)
+metrics_tasks = []                                          # the publisher task and/or http server for the metrics
+calibration_topic = None                                    # where the progress of a calibration is published
+reload_lock = None                                          # 1 reload of the config at a time
+reload_tasks = []                                           # watches config.json for changes
+config_version = None                                       # (mtime, size) of the config.json that is loaded
+is_loaded = False                                           # the assets are loaded, a reload can only happen after this
+coalesce_types = {'dimmer'}                                 # teletask types for which only the latest command is sent (brightness sliders send bursts)
+commands = None                                             # KeyedExecutor for the commands from home assistant: in order per asset, assets in parallel
+
+EVENTS = metrics.counter('main.events')
+EVENTS_IGNORED = metrics.counter('main.events_ignored')     # teletask reports everything, also what isn't in the config
+COMMANDS = metrics.counter('main.commands')
+COMMAND_TIME = metrics.histogram('main.command')            # time to handle a command from home assistant (incl. the ack from teletask)
 
 
 def ask_exit(*args):
-    print("stop called, closing down")
+    logger.info("stop called, closing down")
     STOP.set()
 
 
-async def handle_teletask_event(unit, type, nr, values):
+async def handle_teletask_event(unit, fnc, nr, values):
     """called when a teletask message arrived
         Teletask sends 
     Args:
         unit (nr): the nr of the unit
-        type (string) the teletask function / type
+        fnc (number) the teletask function
         nr (number) the asset number
         values (array) the values that were reported 
     """
-    key = teletask.build_key(unit, type, nr)
-    if key in assets_dict:
-        asset = assets_dict[key]
+    route = routes.get((unit, fnc, nr))
+    if not route:
+        EVENTS_IGNORED.inc()
+    else:
+        EVENTS.inc()
         cover_value = None
-        HA.send(asset, values)
-        if asset['component'] == 'cover':
-            cover_value = await RS.handle_cover_event(key, asset, values)
+        if route.filter:                                    # chatty sensor, the filter decides when to publish
+            route.filter.add(values[0])
+        else:
+            HA.send(route, values)
+        if route.is_cover:
+            cover_value = await RS.handle_cover_event(route.key, route.asset, values)
         if cover_value:
-            HA.send_cover_pos(asset, cover_value)
+            HA.send_cover_pos(route, cover_value)
+
+
+def report_cover_pos(key, position):
+    """called by the roller shutters while a cover is moving, with its estimated position
+    """
+    route = assets_dict.get(key)
+    if route:
+        HA.send_cover_pos(route, position)
+
+
+def report_calibration(progress):
+    """called by the roller shutters while calibrating
+    """
+    HA.publish_diagnostics(calibration_topic, json.dumps(progress).encode())
 
 
 async def calibrate_covers():
     """looks up the list of assets that are used as covers and records the timing for each.
     """
-    covers = [value for key, value in assets_dict.items() if value['component'] == 'cover']
-    await RS.calibrate(covers)
-    for cover in covers:                        # need to let home-assistant know that all covers are closed now
-        HA.send_cover_pos(cover, 0)
+    covers = [route for route in assets_dict.values() if route.is_cover]
+    await RS.calibrate([route.asset for route in covers])
+    for cover in covers:                        # need to let home-assistant know where the covers are now (fully open)
+        if cover.key in RS.COVER_DATA:
+            HA.send_cover_pos(cover, RS.COVER_DATA[cover.key]['position'])
     
 
 async def calibrate_cover(id):
     id = int(id)
-    covers = [value for key, value in assets_dict.items() if value['component'] == 'cover' and value['teletask_id'] == id]
+    covers = [route for route in assets_dict.values() if route.is_cover and route.asset['teletask_id'] == id]
     if len(covers) == 1:
-        await RS.calibrate(covers, False)
-        HA.send_cover_pos(covers[0], 0)
+        if await RS.calibrate([covers[0].asset], False):
+            HA.send_cover_pos(covers[0], RS.COVER_DATA[covers[0].key]['position'])
+
+def submit_command(key, asset, kind, value):
+    """called by home assistant for a command, it's handled after the commands that were already received for
+    the same asset. For the coalesce types, latest wins: a newer value replaces the one that is still waiting.
+    """
+    is_latest_wins = asset['teletask_type'] in coalesce_types
+    commands.submit(key, handle_actuator, key, asset, kind, value, replace=is_latest_wins)
 
-async def handle_actuator(unit, type, nr, value):
+
+async def move_cover(route, value, started):
+    position = await RS.move_to(route.key, route.asset, value, started)
+    if position is not None:                                    # None: failed or replaced by a newer move, which will report
+        HA.send_cover_pos(route, position)
+
+
+async def handle_actuator(key, asset, kind, value):
+    """handles a command from home assistant (runs in the command executor)
+    Args:
+        key (string): the key of the asset
+        asset (object): the asset (or calibrate button) the command is for
+        kind (string): the command: set, setbri, setpos or exec (buttons)
+        value (string): the payload
+    """
+    COMMANDS.inc()
+    start = time.perf_counter()
     try:
-        key = teletask.build_key(unit, type, nr)
-        if key in assets_dict:
-            asset = assets_dict[key]
-            value = value
-            if asset['component'] == 'cover' and value.isnumeric():
-                await RS.move_to(key, asset, int(value))
-                HA.send_cover_pos(asset, value)
+        if asset['teletask_type'] == 'calibrate':                     # the calibrate buttons of the bridge, not the buttons in the config
+            if asset['teletask_id'] == -1:
+                await calibrate_covers()
+            else:
+                await calibrate_cover(asset['teletask_id'])
+        elif key in assets_dict:
+            route = assets_dict[key]
+            asset = route.asset
+            if kind == 'setpos':
+                if value.isnumeric():
+                    # the move runs on its own: the next command for the cover (stop, new position) doesn't wait
+                    # until the move is done, only until the motor got its command
+                    started = asyncio.get_running_loop().create_future()
+                    asyncio.ensure_future(move_cover(route, int(value), started))
+                    await started
+            elif route.is_cover:                                        # stop, open & close also end a move that is running
+                position = await RS.set_cover(key, asset, value)
+                if position is not None:
+                    HA.send_cover_pos(route, position)
             else:
                 await teletask.set_actuator(asset, value)
-        elif key == '1_calibrate_-1':
-            await calibrate_covers()
-        elif key.startswith('1_calibrate_'):
-            await calibrate_cover(key[12:])
     except Exception as e:
-        print('{}'.format(e))
+        logger.exception('failed to handle actuator command: %s', e)
+    COMMAND_TIME.observe(time.perf_counter() - start)
+
+
+def get_config_version():
+    stat = os.stat(Config.CONFIG_FILE)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+async def reload_config():
+    """load config.json again and only apply the changes in the assets: discovery configs & state requests for
+    the new & changed assets, removal of the discovery configs of the deleted ones and new routes for the new &
+    changed assets. The routes of the other assets are kept (with the values their filters are holding back).
+    The connections with teletask & the broker are left as they are.
+    """
+    global config_version
+    if not is_loaded:
+        logger.warning('assets not yet loaded, config not reloaded')
+        return
+    async with reload_lock:
+        try:
+            config_version = get_config_version()
+            config = Config.load()
+            if not config:
+                logger.error('config.json not reloaded, it is invalid')
+                return
+            new_assets = {}
+            for asset, (key, id) in zip(config['assets'], Config.index):
+                new_assets[key] = (asset, id)
+            changed_keys = [key for key, (asset, id) in new_assets.items() if key not in assets_dict or assets_dict[key].asset != asset]
+            changed = [new_assets[key][0] for key in changed_keys]
+            removed = [key for key in assets_dict if key not in new_assets]
+            if not changed and not removed:
+                logger.info('config reloaded, the assets are the same')
+                return
+            for key in removed + changed_keys:
+                route = assets_dict.pop(key, None)
+                if route:
+                    if route.filter:
+                        route.filter.close()
+                    routes.pop(teletask.get_id(route.asset), None)
+                    HA.forget_route(route)                          # a changed asset can have other topics, the new route publishes its states again
+            for key in changed_keys:
+                asset, id = new_assets[key]
+                route = HA.build_route(asset, key)
+                assets_dict[key] = route
+                routes[id] = route
+            HA.update_assets(config['assets'])
+            await teletask.update_assets(config['assets'], changed)
+            logger.info('config reloaded: %d assets added or changed, %d removed', len(changed), len(removed))
+        except Exception as e:
+            logger.exception('failed to reload the config: %s', e)
+
+
+def request_reload(*args):
+    """reload the config from a signal or an mqtt command
+    """
+    logger.info('config reload requested')
+    asyncio.ensure_future(reload_config())
+
+
+async def watch_config(interval):
+    """reload the config when config.json changes
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            version = get_config_version()
+        except OSError:                                     # being replaced
+            continue
+        if version != config_version:
+            await reload_config()
+
+
+def start_reload(config, device_id):
+    """watch config.json and listen for reload commands
+    Args:
+        config (json object): {"watch_interval": number, "topic": "string"}
+    """
+    global config_version, reload_lock
+    config_version = get_config_version()
+    reload_lock = asyncio.Lock()
+    if config.get('watch_interval', 5):
+        reload_tasks.append(asyncio.create_task(watch_config(config.get('watch_interval', 5))))
+    HA.subscribe_command(config.get('topic', 'teletask_bridge/{}/reload'.format(device_id)), request_reload)
 
 
-async def load_assets(items):
+async def load_assets(items, index=None):
     """prepares everything for the assets
 
     Args:
         items (array): list of assets to create a bridge for
+        index (list): the key & teletask id of every asset (see Config.build_index), when already known
     """
-    print("start loading assets")
-    for asset in items:                                                     # build the dict so we can use it as a filter on the data coming from teletask
-        key = teletask.build_key_from_asset(asset)
-        assets_dict[key] = asset
+    logger.info("start loading assets")
+    if not index:
+        index = Config.build_index(items)
+    for asset, (key, id) in zip(items, index):                             # build the dicts so we can use it as a filter on the data coming from teletask
+        route = HA.build_route(asset, key)
+        assets_dict[key] = route
+        routes[id] = route
     await HA.load_assets(items)
     await teletask.load_assets(items)
     for key, value in RS.COVER_DATA.items():
-        HA.send_cover_pos(assets_dict[key], value['position'])
+        if key in assets_dict:
+            HA.send_cover_pos(assets_dict[key], value['position'])
+    global is_loaded
+    is_loaded = True
+
+async def start_metrics(config, device_id):
+    """publish the metrics periodically over mqtt and/or serve them over http
+    Args:
+        config (json object): {"interval": number, "topic": "string", "http_port": number}
+    """
+    if config.get('interval'):
+        topic = config.get('topic', 'teletask_bridge/{}/diagnostics'.format(device_id))
+        publisher = metrics.run_publisher(lambda payload: HA.publish_diagnostics(topic, payload), config['interval'])
+        metrics_tasks.append(asyncio.create_task(publisher))
+    if config.get('http_port'):
+        metrics_tasks.append(await metrics.start_http(config['http_port']))
+
+
+async def stop_metrics():
+    for item in metrics_tasks:
+        if isinstance(item, asyncio.Task):
+            item.cancel()
+        else:
+            item.close()
+            await item.wait_closed()
+    metrics_tasks.clear()
+
 
 async def main(loop):
     """
@@ -92,23 +279,40 @@ async def main(loop):
     config = Config.load()
     if not config:                                          # something went wrong loading the config, don't continue, exit the app
         return
+    Log.configure(config.get('logging'))
     RS.load_config()
-    started = await HA.start(config['home_assistant'], handle_actuator, loop)
+    global calibration_topic
+    calibration_topic = config.get('covers', {}).get('calibration_topic', 'teletask_bridge/{}/calibration'.format(config['home_assistant']['device_id']))
+    RS.start(config.get('covers', {}), report_cover_pos, report_calibration)
+    global commands
+    commands_config = config.get('commands', {})
+    commands = KeyedExecutor(commands_config.get('max_running', 8), commands_config.get('max_queued', 200),
+                             commands_config.get('max_queued_per_asset', 20), 'commands')
+    started = await HA.start(config['home_assistant'], submit_command, loop)
     if not started:
-        print('HA not started, stopping')
+        logger.error('HA not started, stopping')
         return
     started = await teletask.start(config['teletask'], STOP, handle_teletask_event)
     if not started:
-        print('teletask not started, stopping')
+        logger.error('teletask not started, stopping')
         return
-    asyncio.create_task(load_assets(config['assets']))      # do soon, give teletask read a change to start
+    if 'metrics' in config:
+        await start_metrics(config['metrics'], config['home_assistant']['device_id'])
+    start_reload(config.get('reload', {}), config['home_assistant']['device_id'])
+    asyncio.create_task(load_assets(config['assets'], Config.index))      # do soon, give teletask read a change to start
     await teletask.read()                                   # blocks until stop has been set
+    for task in reload_tasks:
+        task.cancel()
+    reload_tasks.clear()
+    await stop_metrics()
+    await commands.stop()
     await HA.stop()
-    RS.save_config()                                        # make certain that the latest cover positions is saved.
+    await RS.flush_config()                                 # make certain that the latest cover positions is saved.
     # teletask is already stopped through th stop signal
 
 
 if __name__ == '__main__':
+    Log.setup()
     loop = asyncio.get_event_loop()
     if platform.system() == 'Windows':
         signal.signal(signal.SIGINT, ask_exit)
@@ -116,6 +320,8 @@ if __name__ == '__main__':
     else:
         loop.add_signal_handler(signal.SIGINT, ask_exit)
         loop.add_signal_handler(signal.SIGTERM, ask_exit)
+        loop.add_signal_handler(signal.SIGHUP, request_reload)
     loop.run_until_complete(main(loop))
     loop.close()
+    Log.stop()
 
@@ -0,0 +1,136 @@
+"""cheap counters, gauges & fixed-bucket histograms for the bridge.
+They can be published periodically as json on an mqtt topic and/or served on a local http /metrics endpoint.
+"""
+import asyncio
+import bisect
+import json
+import logging
+import time
+
+logger = logging.getLogger('main')
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)      # in seconds
+DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+counters = {}
+gauges = {}                                 # name -> function that returns the current value, only called when a snapshot is taken
+histograms = {}
+started_at = time.time()
+
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram:
+    """counts the observed values in fixed buckets, each bucket is the upper bound (inclusive) of the values
+    it counts, values above the last bucket go in the overflow bucket.
+    """
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_json(self):
+        result = {'count': self.count, 'sum': round(self.sum, 6), 'buckets': {}}
+        for bound, count in zip(self.buckets, self.counts):
+            result['buckets'][str(bound)] = count
+        result['buckets']['+inf'] = self.counts[-1]
+        return result
+
+
+def counter(name):
+    """get or create the counter with the name
+    """
+    if name not in counters:
+        counters[name] = Counter()
+    return counters[name]
+
+
+def histogram(name, buckets=LATENCY_BUCKETS):
+    """get or create the histogram with the name
+    """
+    if name not in histograms:
+        histograms[name] = Histogram(buckets)
+    return histograms[name]
+
+
+def gauge(name, value_fn):
+    """register a value that is read when a snapshot is taken, so it costs nothing in between
+    Args:
+        value_fn (func): returns the current value
+    """
+    gauges[name] = value_fn
+
+
+def snapshot():
+    """the current value of all the metrics, as a json serializable object
+    """
+    result = {
+        'uptime': round(time.time() - started_at),
+        'counters': {name: item.value for name, item in counters.items()},
+        'gauges': {},
+        'histograms': {name: item.to_json() for name, item in histograms.items()}
+    }
+    for name, value_fn in gauges.items():
+        try:
+            result['gauges'][name] = value_fn()
+        except Exception as e:
+            logger.warning('failed to read gauge %s: %s', name, e)
+    return result
+
+
+async def run_publisher(publish, interval):
+    """periodically publish the snapshot
+    Args:
+        publish (func): called with the json payload (bytes)
+        interval (number): nr of seconds between publishes
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            publish(json.dumps(snapshot()).encode())
+        except Exception as e:
+            logger.warning('failed to publish metrics: %s', e)
+
+
+async def handle_http(reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()).strip():                # skip the headers
+            pass
+        parts = request.decode('latin-1').split()
+        if len(parts) > 1 and parts[0] == 'GET' and parts[1] == '/metrics':
+            body = json.dumps(snapshot()).encode()
+            header = 'HTTP/1.0 200 OK\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(len(body))
+        else:
+            body = b'not found'
+            header = 'HTTP/1.0 404 Not Found\r\nContent-Length: {}\r\n\r\n'.format(len(body))
+        writer.write(header.encode() + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_http(port, host='0.0.0.0'):
+    """serve the snapshot on http://host:port/metrics
+    Returns:
+        asyncio.Server: the running server
+    """
+    server = await asyncio.start_server(handle_http, host, port)
+    logger.info('metrics available on http://%s:%s/metrics', host, port)
+    return server
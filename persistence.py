@@ -0,0 +1,95 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+
+import metrics
+
+logger = logging.getLogger('main')
+
+
+def write_atomic(path, text):
+    """write the text (str or bytes) to a temp file next to path, fsync it and rename it over path, so a crash
+    halfway leaves either the old or the new file, never a corrupt one.
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.{}.'.format(os.path.basename(path)), suffix='.tmp')
+    try:
+        with (os.fdopen(fd, 'wb') if isinstance(text, bytes) else os.fdopen(fd, 'w', encoding='utf-8')) as file:
+            file.write(text)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    if hasattr(os, 'O_DIRECTORY'):                              # make the rename itself durable (not possible on windows)
+        dir_fd = os.open(folder, os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class JsonStore:
+    """write-behind storage for a json file: changes only mark the data as dirty, it gets written
+    'delay' seconds later from a worker thread, so multiple changes result in 1 write and the
+    event loop never blocks on the disk.
+    """
+
+    def __init__(self, path, get_data, delay=2.0, name='store'):
+        """
+        Args:
+            path (string): the file to write to
+            get_data (func): returns the (json serializable) data to save
+            delay (number): nr of seconds between the first change and the write
+            name (string): name used for the metrics
+        """
+        self.path = path
+        self.get_data = get_data
+        self.delay = delay
+        self.flush_handle = None                    # scheduled flush
+        self.lock = None                            # only 1 write at a time, in the order they were requested
+        self.flush_time = metrics.histogram(name + '.flush')
+        self.flushes = metrics.counter(name + '.flushes')
+
+    def mark_dirty(self):
+        """the data changed, make certain it gets written soon
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:                        # no event loop (anymore), write it right away
+            self.write(self.serialize())
+            return
+        if not self.flush_handle:
+            self.flush_handle = loop.call_later(self.delay, self.start_flush)
+
+    def start_flush(self):
+        self.flush_handle = None
+        asyncio.ensure_future(self.flush())
+
+    def serialize(self):
+        return json.dumps(self.get_data(), indent=4)
+
+    async def flush(self):
+        """write the data now (if a write was scheduled, it's no longer needed)
+        """
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.lock:
+            self.lock = asyncio.Lock()
+        text = self.serialize()                     # take the snapshot on the loop, the data can change while writing
+        async with self.lock:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.write, text)
+            except Exception as e:
+                logger.error('failed to save %s: %s', self.path, e)
+
+    def write(self, text):
+        start = time.perf_counter()
+        write_atomic(self.path, text)
+        self.flush_time.observe(time.perf_counter() - start)
+        self.flushes.inc()
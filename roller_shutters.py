@@ -1,12 +1,57 @@
 import asyncio
 import json
+import logging
 import os
 import time
 
 import teletask
+from persistence import JsonStore
+
+logger = logging.getLogger('roller_shutters')
 
 COVER_DATA = None
-is_calibrating = False                      # flag that keeps track if we are calibrating or not
+calibrating = {}                            # key -> the cover data that is being measured, only stored in COVER_DATA (and saved) once it's done
+SAVE_DELAY = 2.0                            # nr of seconds between a change of the cover data and writing it to disk
+RUNTIME_FIELDS = ('wait_for', 'move_start_at', 'move_direction')        # cover values that only have a meaning while running, never saved
+moves = {}                                  # key -> the task that is currently moving the cover, 1 per cover
+position_interval = 0.5                     # nr of seconds between 2 position updates of a moving cover, 0 = only report the end position
+on_position = None                          # callback(key, position) for the positions of moving covers
+moving_covers = {}                          # key -> last reported position, for the covers that are moving
+position_timer = None                       # 1 timer for all the moving covers
+on_progress = None                          # callback(progress) for the calibration progress
+calibration = {
+    'max_motors': 4,                        # nr of covers that are calibrated at the same time
+    'spacing': 1.0,                         # min nr of seconds between 2 motor starts
+    'timeout': 120.0,                       # max nr of seconds a cover can take to fully open or close
+    'min_duration': 2.0,                    # a cover that moves faster than this didn't really move
+    'tolerance': 0.2,                       # recalibrate when the timing differs more than this fraction from the previous calibration
+    'retries': 1                            # nr of times an outlier is recalibrated
+}
+
+
+def get_saveable_data():
+    """the cover data without the runtime only values (calibration events, the running move)
+    """
+    return {key: {name: value for name, value in cover.items() if name not in RUNTIME_FIELDS} for key, cover in COVER_DATA.items()}
+
+
+store = JsonStore('covers.json', get_saveable_data, SAVE_DELAY, 'roller_shutters')
+
+def start(config, callback, progress_callback=None):
+    """set up the reporting of the positions while covers are moving and the calibration
+
+    Args:
+        config (json object): the covers section of the config
+        callback (func): called with the key and the position of a moving cover
+        progress_callback (func): called with the progress of a calibration
+    """
+    global position_interval, on_position, on_progress
+    position_interval = config.get('position_interval', position_interval)
+    on_position = callback
+    on_progress = progress_callback
+    for name in calibration:
+        calibration[name] = config.get('calibration_' + name, calibration[name])
+
 
 def load_config():
     """load the data
@@ -15,63 +60,233 @@ def load_config():
         items (list): asset items
     """
     global COVER_DATA
-    print('load cover configs')
+    logger.info('load cover configs')
     if not os.path.exists('covers.json'):
-        print("no cover configs found, resetting to empty")
+        logger.info("no cover configs found, resetting to empty")
         COVER_DATA = {}
         return
     with open('covers.json', 'r') as file:
         COVER_DATA = json.load(file)
-        print("found cover data: {}".format(json.dumps(COVER_DATA)))
+        for key, cover in list(COVER_DATA.items()):
+            if 'position' not in cover:                     # an unfinished calibration that older versions saved
+                logger.warning('incomplete cover data for %s, the cover needs to be calibrated', key)
+                del COVER_DATA[key]
+                continue
+            for name in RUNTIME_FIELDS:                     # older files stored the wall-clock start of a move, meaningless now
+                cover.pop(name, None)
+        logger.debug("found cover data: %s", COVER_DATA)
 
 
 def save_config():
-    print("saving the new config")
-    with open('covers.json', 'w') as file:
-        json.dump(COVER_DATA, file, indent=4)
+    """the cover data changed, it will be written to disk a little later (from a worker thread)
+    """
+    logger.debug("saving the new config")
+    store.mark_dirty()
+
+
+async def flush_config():
+    """write the cover data right away, used when closing down
+    """
+    await store.flush()
+
+class MotorBudget:
+    """the electrical budget for calibrating: at most 'max_motors' covers calibrate at the same time
+    and 2 motors never start within 'spacing' seconds of each other.
+    """
+
+    def __init__(self, max_motors, spacing):
+        self.slots = asyncio.Semaphore(max_motors)
+        self.spacing = spacing
+        self.next_start = 0                         # monotonic time of the earliest next motor start
+
+    async def wait_for_start(self):
+        """wait until a motor is allowed to start
+        """
+        now = time.monotonic()
+        start_at = max(now, self.next_start)
+        self.next_start = start_at + self.spacing              # reserve the slot before sleeping, so the starts are spread out
+        if start_at > now:
+            await asyncio.sleep(start_at - now)
+
 
 async def calibrate(items, overwrite=True):
-    """measures the timing of all the items in the list
+    """measures the timing of all the items in the list. The covers are calibrated in parallel,
+    within the limits of the motor budget.
 
     Args:
         items (lsit): asset items
+        overwrite (bool): when true, the data of the covers that aren't in the list is removed
+    Returns: the list of keys that were calibrated
     """
-    global is_calibrating, COVER_DATA
-    is_calibrating = True
-    try:
-        print("beginning calibration")
-        if overwrite:
-            COVER_DATA = {}
-        to_wait_for = []
-        for cover in items:
-            key = teletask.build_key_from_asset(cover)
-            new_cover = {
-                'wait_for': asyncio.Event(),
-                'move_start_at': time.time()
-            }
-            COVER_DATA[key] = new_cover
-            to_wait_for.append(new_cover['wait_for'].wait())
-            print("preparing cover {} for calibration".format(key))
-            await teletask.set_actuator(cover, 'OPEN')          # first make certain that the cover is fully opened before starting to measure.
-            await asyncio.sleep(2.1)                            # wait a little bit (just a little longer than the ack-timeout to be save) before starting the next cover so that the electric system doesn't have too many issssues
-        print("waiting for calibration to complete")
-        done, pending = await asyncio.wait(to_wait_for)         # wait until all covers have reported being done with the calibration
-        print("calibration done")
-        save_config()
-    finally:
-        is_calibrating = False
+    logger.info("beginning calibration")
+    budget = MotorBudget(calibration['max_motors'], calibration['spacing'])
+    progress = {'state': 'running', 'total': len(items), 'done': 0, 'failed': [], 'running': []}
+    report_progress(progress)
+    keys = [teletask.build_key_from_asset(cover) for cover in items]
+    results = await asyncio.gather(*[calibrate_cover(key, cover, COVER_DATA.get(key), budget, progress) for key, cover in zip(keys, items)])
+    if overwrite:
+        for key in set(COVER_DATA) - set(keys):
+            del COVER_DATA[key]
+    progress['state'] = 'done'
+    report_progress(progress)
+    logger.info("calibration done")
+    save_config()
+    return [key for key, ok in zip(keys, results) if ok]
+
+async def calibrate_cover(key, asset, previous, budget, progress):
+    """measure the time a cover needs to close and open, recalibrate it when the result is an outlier.
+    The previous data of the cover stays in COVER_DATA until the new timing is known.
+
+    Args:
+        key (string): the key that identifies the asset
+        asset (object): the cover config data
+        previous (object): the cover data of the previous calibration (if any)
+        budget (MotorBudget): limits the nr of motors running
+        progress (object): the progress of the whole calibration, updated & reported
+    Returns: True when the cover is calibrated
+    """
+    async with budget.slots:
+        progress['running'].append(asset['name'])
+        report_progress(progress)
+        try:
+            for attempt in range(calibration['retries'] + 1):
+                cover = {}
+                calibrating[key] = cover
+                try:
+                    await run_motor(key, asset, cover, 'OPEN', budget)                    # first make certain that the cover is fully opened before starting to measure.
+                    cover['duration_down'] = await run_motor(key, asset, cover, 'CLOSE', budget)
+                    cover['duration_up'] = await run_motor(key, asset, cover, 'OPEN', budget)
+                except asyncio.TimeoutError:
+                    logger.error("calibration of cover %s timed out", asset['name'])
+                    await teletask.set_actuator(asset, 'STOP')
+                    continue
+                cover['position'] = 100                                                  # cover is now fully open
+                logger.info("total cover duration down: %s, up: %s for %s", cover['duration_down'], cover['duration_up'], asset['name'])
+                if not is_outlier(cover, previous):
+                    COVER_DATA[key] = cover
+                    return True
+                if not previous:                                                         # too short, there is nothing to compare with
+                    logger.warning("calibration of cover %s too short (down: %.2f, up: %.2f)", asset['name'], cover['duration_down'], cover['duration_up'])
+                else:
+                    logger.warning("calibration of cover %s differs too much from the previous one (down: %s, up: %s)", asset['name'], previous.get('duration_down'), previous.get('duration_up'))
+            if 'duration_up' in cover and not is_outlier(cover, None):                   # still different after recalibrating: the cover really changed, keep the new timing
+                COVER_DATA[key] = cover
+                return True
+            progress['failed'].append(asset['name'])
+            return False
+        finally:
+            calibrating.pop(key, None)
+            cover.pop('wait_for', None)
+            cover.pop('move_start_at', None)
+            progress['running'].remove(asset['name'])
+            progress['done'] += 1
+            report_progress(progress)
+
+async def run_motor(key, asset, cover, direction, budget):
+    """start the motor of the cover in the direction and wait until teletask reports it stopped (end position)
+
+    Returns: the nr of seconds the motor ran
+    Raises: asyncio.TimeoutError when the cover didn't stop in time or didn't start
+    """
+    await budget.wait_for_start()
+    stopped = asyncio.get_running_loop().create_future()
+    cover['wait_for'] = (direction == 'OPEN', stopped)                             # the direction tells which stop event is for this move (they come 2 times)
+    cover['move_start_at'] = time.monotonic()
+    if not await teletask.set_actuator(asset, direction):
+        raise asyncio.TimeoutError()
+    await asyncio.wait_for(stopped, calibration['timeout'])
+    return time.monotonic() - cover.pop('move_start_at')
+
+def is_outlier(cover, previous):
+    """check if the measured timing of the cover is suspicious: too short or a lot different from
+    the previous calibration
+    """
+    for name in ('duration_down', 'duration_up'):
+        if cover[name] < calibration['min_duration']:
+            return True
+        if previous and name in previous and abs(cover[name] - previous[name]) > previous[name] * calibration['tolerance']:
+            return True
+    return False
+
+def report_progress(progress):
+    if on_progress:
+        try:
+            on_progress(progress)
+        except Exception as e:
+            logger.warning('failed to report calibration progress: %s', e)
+
+def get_position(cover, now=None):
+    """the position of the cover, while it is moving, this is interpolated from the start of the move
+
+    Args:
+        cover (object): cover data
+        now (number): monotonic time to calculate the position for, default is the current time
+    Returns: the position (0 - 100)
+    """
+    if 'move_start_at' not in cover or 'move_direction' not in cover:
+        return cover['position']
+    if now is None:
+        now = time.monotonic()
+    is_closing = cover['move_direction'] == 'CLOSE'
+    total_time = cover['duration_down'] if is_closing else cover['duration_up']
+    change = 100 / total_time * (now - cover['move_start_at'])
+    new_value = cover['position'] - change if is_closing else cover['position'] + change
+    return round(min(100, max(0, new_value)))
+
+def begin_move(key, cover, direction, start_at):
+    """the cover started moving (from the current position), report its position while moving
+    """
+    cover['move_start_at'] = start_at
+    cover['move_direction'] = direction
+    if not position_interval or not on_position:
+        return
+    moving_covers.setdefault(key, cover['position'])
+    if not position_timer:
+        report_positions()
+
+def end_move(key, cover, position):
+    """the cover stopped moving at the position
+    """
+    cover['position'] = position
+    cover.pop('move_start_at', None)
+    cover.pop('move_direction', None)
+    moving_covers.pop(key, None)
+    save_config()
 
-def calculate_pos(cover, is_closing):
+def report_positions():
+    """timer tick: report the interpolated position of every moving cover, when it changed.
+    The timer stops when no cover is moving anymore.
+    """
+    global position_timer
+    position_timer = None
+    now = time.monotonic()
+    for key, last_pos in list(moving_covers.items()):
+        cover = COVER_DATA.get(key)
+        if not cover or 'move_direction' not in cover:
+            del moving_covers[key]
+            continue
+        position = get_position(cover, now)
+        if position != last_pos:
+            moving_covers[key] = position
+            try:
+                on_position(key, position)
+            except Exception as e:
+                logger.warning('failed to report position of %s: %s', key, e)
+    if moving_covers:
+        position_timer = asyncio.get_running_loop().call_later(position_interval, report_positions)
+
+def calculate_pos(key, cover, is_closing):
     """cover has stopped moving, so calculate the duration of the movement and adjust
     the current position accordingly
 
     Args:
+        key (string): the key that identifies the asset
         cover (object): cover data
         is_closing (bool): was the cover closing or opening
     Returns: if a new value is calculated, this is returned
     """
     if 'move_start_at' in cover:                                        # the end event actually comes 2 times, looks like an update in it's own position value (bad), so we need to skip this
-        duration = time.time() - cover['move_start_at']
+        duration = time.monotonic() - cover['move_start_at']
         total_time = cover['duration_down'] if is_closing else cover['duration_up']
         change = 100 / total_time * duration                     # percentage that the cover moved
         change = round(change)                                          # keep it in the integer range
@@ -84,9 +299,7 @@ def calculate_pos(cover, is_closing):
             new_value = 0
         if new_value > 100:
             new_value = 100
-        cover['position'] = new_value
-        del cover['move_start_at']                                      # value no longer needed
-        save_config()
+        end_move(key, cover, new_value)
         return new_value
 
 async def handle_cover_event(key, asset, values):
@@ -95,71 +308,141 @@ async def handle_cover_event(key, asset, values):
     Args:
         key (string): the key that identifies the asset
         asset (object): the cover config data
-        values (list): byte values received from teletask
+        values (MotorState): direction & state received from teletask
     Returns: if a new cover value is calculated, this is returned
     """
     direction_up = values[0] == 1
     moving = not (values[1] == 0)
-    print("received cover event: is_up={} - moving={}".format(direction_up, moving))
-    if not key in COVER_DATA:
-        print('event for uncalibrated cover: {}, skipping'.format(asset['name']))
+    logger.debug("received cover event: is_up=%s - moving=%s", direction_up, moving)
+    cover = calibrating.get(key) or COVER_DATA.get(key)
+    if cover is None:
+        logger.info('event for uncalibrated cover: %s, skipping', asset['name'])
         return
-    cover = COVER_DATA[key]
     if moving:                                                          # movement started, only record if didn't come from us (to get timing best)
         if not 'move_start_at' in cover:                                # sometimes, we get the even slowly, so when possible, store it when the command is sent
-            cover['move_start_at'] = time.time()
-            print("move started at: {}".format(cover['move_start_at']))
+            if 'duration_up' in cover:                                  # not calibrating: moved from the wall, so the position can be interpolated
+                begin_move(key, cover, 'OPEN' if direction_up else 'CLOSE', time.monotonic())
+            else:
+                cover['move_start_at'] = time.monotonic()
+            logger.debug("move started at: %s", cover['move_start_at'])
         else: 
-            print("move start event received at: {}, original: {}".format(time.time(), cover['move_start_at']))
-    elif not is_calibrating:
-        return calculate_pos(cover, values[0] == 2)
-    else:                                                # movement stopped
-        if direction_up == True:                                        # cover fully open
-            if 'duration_down' in cover:                                # calibration is done for going up, process fully done for this cover
-                cover['duration_up'] = time.time() - cover['move_start_at']
-                print("total cover duration up: {} for {}".format(cover['duration_up'], asset['name']))
-                del cover['move_start_at']                              # value no longer needed
-                cover['position'] = 100                                 # cover is now fully closed, so set position to 0
-                cover['wait_for'].set()
-                del cover['wait_for']
-            else:                                                       # cover open after start of calibration. we can start closing it to begin the full measurement
-                print("closing cover to start measuring")
-                cover['move_start_at'] = time.time()
-                await teletask.set_actuator(asset, 'CLOSE')
-        elif not 'duration_down' in cover:                              # cover is fully closed, calibration going down is done. we get this event 2 times, so skip the second.
-            cover['duration_down'] = time.time() - cover['move_start_at']
-            print("total cover duration down: {} for {}".format(cover['duration_down'], asset['name']))
-            cover['position'] = 0                                       # cover is now fully closed, so set position to 0
-            await asyncio.sleep(2.1)                                    # give some time to let the motor rest. Don't overburden the electric system (just a little longer than the ack-timeout to be save)
-            cover['move_start_at'] = time.time()                        # to make certain that we have this, could mis it (if didn't get ack in time for set_actuator)
-            await teletask.set_actuator(asset, 'OPEN')
-
-async def move_to(key, asset, value):
-    """moves the cover to the specified position
+            logger.debug("move start event received at: %s, original: %s", time.monotonic(), cover['move_start_at'])
+    elif key in moves:
+        if 'move_direction' not in cover:                               # the scheduler stopped it (or is stopping it), it already knows the position
+            return
+        return stop_moving(key, cover)                                  # stopped from the outside (wall switch, end position) during the move
+    elif 'wait_for' in cover:                                            # calibrating: let the cover know it reached the end
+        expect_up, stopped = cover['wait_for']
+        if expect_up == direction_up and not stopped.done():
+            stopped.set_result(True)
+    else:
+        return calculate_pos(key, cover, values[0] == 2)
+
+def stop_moving(key, cover):
+    """the running move is cancelled, the cover stays where it got to
+    Returns: the position of the cover
+    """
+    task = moves.pop(key, None)
+    if task:
+        task.cancel()
+    position = get_position(cover)
+    end_move(key, cover, position)
+    return position
+
+async def set_cover(key, asset, value):
+    """a STOP, OPEN or CLOSE command for the cover: a move that is running is cancelled first, so the move
+    doesn't continue to track (and later stop) the cover.
+
+    Args:
+        key (string): the key that identifies the asset
+        asset (object): the cover
+        value (string): STOP, OPEN or CLOSE
+    Returns: the position where the cover was stopped, None if it wasn't stopped or the position isn't known
+    """
+    cover = COVER_DATA.get(key) if COVER_DATA else None
+    if not cover or key in calibrating or 'duration_up' not in cover or value not in ('STOP', 'OPEN', 'CLOSE'):
+        await teletask.set_actuator(asset, value)
+        return None
+    position = stop_moving(key, cover) if key in moves else None
+    if value == 'STOP':
+        await teletask.set_actuator(asset, value)                      # a move from the wall is ended by the stop event
+        return position
+    now = time.monotonic()
+    cover['position'] = get_position(cover, now)                        # it might be moving from the wall
+    begin_move(key, cover, value, now)                                  # ends with the stop event (end position or stop)
+    if not await teletask.set_actuator(asset, value):
+        logger.error('failed to start moving cover %s', asset['name'])
+        end_move(key, cover, cover['position'])
+    return position
+
+async def move_to(key, asset, value, started=None):
+    """moves the cover to the specified position. Every cover has at most 1 move running: a new
+    position for a cover that is still moving cancels the current move and continues from the
+    (interpolated) position where the cover is at that moment.
 
     Args:
+        key (string): the key that identifies the asset
         asset (object): the cover to change the position of
         value (integer): the absolute position to move to
+        started (future): resolved once the motor got its command (or the move ended without one)
+    Returns: the position where the cover stopped, None if the move failed or was replaced by a newer one
     """
-    if not key in COVER_DATA:
-        print('move cover request for uncalibrated cover: {}, skipping'.format(asset['name']))
-        return
-    
-    cover = COVER_DATA[key]
-    current_pos = int(cover['position'])                                # safety: make certain we compare numbers
+    try:
+        if not key in COVER_DATA or 'duration_up' not in COVER_DATA[key]:
+            logger.warning('move cover request for uncalibrated cover: %s, skipping', asset['name'])
+            return
+        if key in calibrating:
+            logger.warning('move cover request for %s while it is calibrating, skipping', asset['name'])
+            return
+        previous = moves.get(key)
+        if previous:
+            previous.cancel()
+            try:
+                await previous                                              # let it clean up before the new move takes over
+            except asyncio.CancelledError:
+                pass
+        task = asyncio.ensure_future(run_move(key, asset, COVER_DATA[key], value, started))
+        moves[key] = task
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if task.cancelled():                                            # replaced by a newer move
+                return None
+            raise
+        finally:
+            if moves.get(key) is task:
+                del moves[key]
+    finally:
+        if started and not started.done():                                 # no move: uncalibrated, failed or replaced before it started
+            started.set_result(None)
+
+async def run_move(key, asset, cover, value, started=None):
+    """the actual move, runs as the task of the cover in 'moves'
+    """
+    now = time.monotonic()
+    moving = cover.get('move_direction')                                # direction the motor is going in now (if any)
+    current_pos = get_position(cover, now)
+    cover['position'] = current_pos                                     # the new move starts from here
     if current_pos == value:
-        print('move cover request for {} to {} already there'.format(asset['name'], value))
-        return
-    print("moving cover {} to {}".format(asset['name'], value))
-    dif = abs(value - current_pos)
-    cover['move_start_at'] = time.time()
-    if value > current_pos:
-        move_duration = cover['duration_up'] / 100 * dif
-        await teletask.set_actuator(asset, 'OPEN')
-    else:
-        move_duration = cover['duration_down'] / 100 * dif
-        await  teletask.set_actuator(asset, 'CLOSE')
-    await asyncio.sleep(move_duration)
-    await  teletask.set_actuator(asset, 'STOP')
-    cover['position'] = value
-    save_config()
\ No newline at end of file
+        logger.info('move cover request for %s to %s already there', asset['name'], value)
+        end_move(key, cover, value)
+        if moving and not await asyncio.shield(teletask.set_actuator(asset, 'STOP')):
+            logger.error('failed to stop cover %s', asset['name'])
+        return value
+    logger.info("moving cover %s from %s to %s", asset['name'], current_pos, value)
+    direction = 'OPEN' if value > current_pos else 'CLOSE'
+    total_time = cover['duration_up'] if direction == 'OPEN' else cover['duration_down']
+    move_duration = total_time / 100 * abs(value - current_pos)
+    begin_move(key, cover, direction, now)
+    if moving != direction:                                             # when the motor is already going the right way, only the stop moves
+        if not await teletask.set_actuator(asset, direction):           # teletask didn't ack, so we don't know if the cover is moving, don't change the position
+            logger.error('failed to start moving cover %s', asset['name'])
+            end_move(key, cover, current_pos)
+            return None
+    if started and not started.done():
+        started.set_result(None)
+    await asyncio.sleep(max(0, now + move_duration - time.monotonic()))
+    end_move(key, cover, value)                                         # before the stop, so the stop event doesn't recalculate it
+    if not await asyncio.shield(teletask.set_actuator(asset, 'STOP')):  # a newer move can't cancel the stop halfway
+        logger.error('failed to stop cover %s', asset['name'])
+    return value
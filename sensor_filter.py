@@ -0,0 +1,92 @@
+import asyncio
+import time
+from collections import deque
+
+import metrics
+
+SUPPRESSED = metrics.counter('sensor_filter.suppressed')          # values that weren't published (right away)
+FLUSHED = metrics.counter('sensor_filter.flushed')                # held back values that were published later
+
+FILTER_FIELDS = ('deadband', 'deadband_relative', 'min_interval', 'smoothing')
+
+
+def has_filter(asset):
+    """check if the asset config asks for filtering of its values
+    """
+    return any(name in asset for name in FILTER_FIELDS)
+
+
+class SensorFilter:
+    """limits the values of a chatty sensor that get published: small changes (deadband) and changes that
+    come too fast (min interval) are held back, optionally after smoothing with a moving average.
+    The latest value that was held back is published later on (flush), so it's never lost.
+    """
+
+    def __init__(self, config, publish):
+        """
+        Args:
+            config (json object): the asset config: {"deadband": number, "deadband_relative": number, "min_interval": number,
+                "smoothing": number, "flush_delay": number}
+            publish (func): called with the value that needs to be published
+        """
+        self.deadband = config.get('deadband', 0)                       # absolute change needed to publish
+        self.deadband_relative = config.get('deadband_relative', 0)     # change as a fraction of the last published value
+        self.min_interval = config.get('min_interval', 0)               # nr of seconds between 2 publishes
+        self.flush_delay = config.get('flush_delay', 300)               # a value within the deadband is published after this nr of seconds
+        window = config.get('smoothing', 1)
+        self.samples = deque(maxlen=window) if window > 1 else None
+        self.publish = publish
+        self.last_value = None                      # the last published value
+        self.published_at = 0
+        self.pending = None                         # the latest value that was held back
+        self.flush_handle = None
+
+    def add(self, value):
+        """a new value was reported, publish it if it passes the filter
+        """
+        if self.samples is not None:
+            self.samples.append(value)
+            value = round(sum(self.samples) / len(self.samples), 2)
+        now = time.monotonic()
+        if self.last_value is None:
+            self.send(value, now)
+            return
+        is_changed = abs(value - self.last_value) > max(self.deadband, abs(self.last_value) * self.deadband_relative)
+        if is_changed and now - self.published_at >= self.min_interval:
+            self.send(value, now)
+            return
+        SUPPRESSED.inc()
+        self.pending = value
+        if is_changed:                              # too soon, publish when the interval has passed
+            self.schedule_flush(self.published_at + self.min_interval - now, True)
+        elif value != self.last_value:
+            self.schedule_flush(max(self.flush_delay, self.min_interval), False)
+
+    def schedule_flush(self, delay, is_changed):
+        if self.flush_handle:
+            if not is_changed:                      # a flush is already scheduled, it will take the latest value
+                return
+            self.flush_handle.cancel()
+        self.flush_handle = asyncio.get_running_loop().call_later(max(0, delay), self.flush)
+
+    def flush(self):
+        """publish the value that was held back
+        """
+        self.flush_handle = None
+        if self.pending is not None and self.pending != self.last_value:
+            FLUSHED.inc()
+            self.send(self.pending, time.monotonic())
+
+    def send(self, value, now):
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        self.pending = None
+        self.last_value = value
+        self.published_at = now
+        self.publish(value)
+
+    def close(self):
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
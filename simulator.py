@@ -0,0 +1,170 @@
+"""a stand-in for a teletask central unit (MICROS+), so the bridge can be run and measured without the real thing.
+It speaks the same framing as teletask: LOG, GET, SET & KEEP_ALIVE commands are acked, GET and SET are answered
+with a REPORT (for the functions that are being logged) and it can generate storms of REPORT events.
+usage: python simulator.py [port]
+"""
+import asyncio
+import random
+import sys
+import time
+
+import teletask
+import teletask_const as const
+
+SENSOR_OFFSET = 2730                        # teletask reports temperatures in 0.1 kelvin
+
+
+def build_frame(msg):
+    """wraps the message in a frame: start byte, length, message & checksum
+    """
+    body = [teletask.FRAME_START, 0x00] + msg
+    body[1] = len(body)
+    body.append(teletask.get_checksum(body))
+    return bytes(body)
+
+
+class Simulator:
+    """simulated central unit. Keeps the state of every (unit, fnc, nr) it was asked about and
+    sends reports to all connected clients.
+    """
+
+    def __init__(self, unit=1, ack_delay=0.0):
+        """
+        Args:
+            unit (number): the nr of the central unit
+            ack_delay (number): nr of seconds to wait before a command is acked, to simulate a slow unit
+        """
+        self.unit = unit
+        self.ack_delay = ack_delay
+        self.states = {}                    # (fnc, nr) -> list of values, as reported after the state byte
+        self.logged = set()                 # the functions for which reports are sent
+        self.writers = []
+        self.server = None
+        self.commands = 0                   # nr of commands received
+        self.sent_at = {}                   # (unit, fnc, nr) -> list of timestamps at which an event was sent, used for latency measurements
+        self.on_command = None              # optional callback, called with every command that is received (before it is acked)
+
+    async def start(self, host='127.0.0.1', port=0):
+        """start listening
+        Returns:
+            number: the port that is listened on
+        """
+        self.server = await asyncio.start_server(self.handle_client, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        for writer in self.writers:
+            writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle_client(self, reader, writer):
+        self.writers.append(writer)
+        parser = teletask.FrameParser()
+        try:
+            while True:
+                data = await reader.read(teletask.READ_SIZE)
+                if not data:
+                    break
+                for frame in parser.feed(data):
+                    await self.handle_command(writer, frame[2:-1])
+        except (ConnectionError, asyncio.CancelledError):      # client or simulator stopped
+            pass
+        finally:
+            self.writers.remove(writer)
+            writer.close()
+
+    async def handle_command(self, writer, msg):
+        """ack the command and do what it asks
+        Args:
+            msg (bytes): the command, without start byte, length & checksum
+        """
+        self.commands += 1
+        if self.on_command:
+            self.on_command(msg)
+        if self.ack_delay:
+            await asyncio.sleep(self.ack_delay)
+        writer.write(bytes([const.COMMAND_ACK]))
+        command = msg[0]
+        if command == const.COMMAND_LOG:
+            if msg[2] == const.SET_ON:
+                self.logged.add(msg[1])
+            else:
+                self.logged.discard(msg[1])
+        elif command == const.COMMAND_GET:
+            fnc, nr = msg[2], int.from_bytes(msg[3:5], 'big')
+            self.report(fnc, nr)
+        elif command == const.COMMAND_SET:
+            fnc, nr, value = msg[2], int.from_bytes(msg[3:5], 'big'), msg[5]
+            self.states[(fnc, nr)] = self.apply(fnc, nr, value)
+            self.report(fnc, nr)
+
+    def get_state(self, fnc, nr):
+        if (fnc, nr) not in self.states:
+            if fnc == const.FNC_MOTORFNC:
+                self.states[(fnc, nr)] = [1, 0]                 # direction up, stopped
+            elif fnc == const.FNC_SENSOR:
+                temp = SENSOR_OFFSET + 200 + nr
+                self.states[(fnc, nr)] = [temp >> 8, temp & 0xFF] * 4    # value, target, day & night
+            else:
+                self.states[(fnc, nr)] = [0]
+        return self.states[(fnc, nr)]
+
+    def apply(self, fnc, nr, value):
+        """the new state of the asset after a SET command
+        """
+        if fnc == const.FNC_MOTORFNC:
+            if value == const.SET_MTRSTOP:
+                return [self.get_state(fnc, nr)[0], 0]
+            return [value, 1]
+        elif fnc == const.FNC_DIMMER:
+            return [0 if value == const.SET_OFF else (100 if value == const.SET_ON else value)]
+        return [value]
+
+    def report(self, fnc, nr):
+        """send the current state of the asset to all the clients (if it's function is being logged)
+        """
+        if fnc not in self.logged:
+            return
+        frame = build_frame([const.COMMAND_REPORT, self.unit, fnc, nr >> 8, nr & 0xFF, 0] + self.get_state(fnc, nr))
+        self.sent_at.setdefault((self.unit, fnc, nr), []).append(time.perf_counter())
+        for writer in self.writers:
+            writer.write(frame)
+
+    async def storm(self, assets, count, rate=0):
+        """send a burst of events, every event changes the state of the asset, so it needs to be published.
+        Args:
+            assets (list): (fnc, nr) pairs of the assets to send events for
+            count (number): nr of events to send
+            rate (number): nr of events per second, 0 = as fast as possible
+        """
+        delay = 1 / rate if rate else 0
+        for i in range(count):
+            fnc, nr = random.choice(assets)
+            state = self.get_state(fnc, nr)
+            if fnc == const.FNC_MOTORFNC:
+                state[1] = 0 if state[1] else 1
+            elif fnc == const.FNC_SENSOR:
+                temp = int.from_bytes(bytes(state[0:2]), 'big') + random.choice([-1, 1])
+                state[0:2] = [temp >> 8, temp & 0xFF]
+            else:
+                state[0] = 0 if state[0] else 255
+            self.report(fnc, nr)
+            if delay:
+                await asyncio.sleep(delay)
+            elif i % 100 == 0:
+                for writer in self.writers:             # don't let the buffers grow endlessly
+                    await writer.drain()
+                await asyncio.sleep(0)
+
+
+async def run(port):
+    simulator = Simulator()
+    port = await simulator.start('0.0.0.0', port)
+    print('teletask simulator listening on port {}'.format(port))
+    async with simulator.server:
+        await simulator.server.serve_forever()
+
+
+if __name__ == '__main__':
+    asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 55957))
@@ -1,17 +1,41 @@
 import asyncio
-import math
+import logging
+import time
 import teletask_const as const
+import codec
+from backoff import Backoff
+from command_channel import CommandChannel
+import metrics
+from logger import FrameTracer
 
-reader = None                   # streams for reading & writing
-writer = None
-waiting_for_ack = None          # when assigned, a asyncio.Event that indicates the set_actuator is waiting for an ack
-keep_alive_task = None          # task that runs making certain that the connection is kept open
-
-is_stopped = False              # flag gets set when we need to go out of the reader loop
+connections = {}                # central unit nr -> Connection, 1 for every teletask unit
 
 stop_signal = None                     # signal that helps us stop the reader loop
 on_event = None                 # callback for main, when we receive a message from teletaslk and it needs to be dispatched
 
+logger = logging.getLogger('teletask')
+tracer = FrameTracer(logger)    # logs the raw frames when the teletask logger is set to DEBUG
+
+sync_window = 10                # nr of GET commands that are sent together during the startup sync
+sync_timeout = 2.0              # nr of seconds to wait for the reports of a sync round
+sync_rounds = 3                 # nr of times the assets that didn't report yet are requested again
+
+READ_SIZE = 1024                # max nr of bytes to read from the socket in 1 go
+FRAME_START = 0x02              # every frame (except an ack) starts with this byte
+MIN_FRAME_LENGTH = 3            # start byte, length & command
+MAX_FRAME_LENGTH = 64           # anything bigger is regarded as garbage, so we don't wait for data that never comes
+
+FRAMES_IN = metrics.counter('teletask.frames_in')
+FRAMES_DROPPED = metrics.counter('teletask.frames_dropped')         # reports of assets that aren't in the config, dropped before decoding
+PARSE_TIME = metrics.histogram('teletask.parse')                    # time to extract the frames from 1 read
+EVENT_LATENCY = metrics.histogram('teletask.event_latency')         # from reading the data until the event has been dispatched (published)
+metrics.gauge('teletask.checksum_failures', lambda: sum(item.parser.checksum_errors for item in connections.values() if item.parser))
+metrics.gauge('teletask.skipped_bytes', lambda: sum(item.parser.skipped_bytes for item in connections.values() if item.parser))
+metrics.gauge('teletask.in_flight', lambda: sum(len(item.channel.in_flight) for item in connections.values() if item.channel))
+metrics.gauge('teletask.queued', lambda: sum(len(item.channel.queue) for item in connections.values() if item.channel))
+metrics.gauge('teletask.connected', lambda: bool(connections) and all(item.is_connected for item in connections.values()))
+RECONNECTS = metrics.counter('teletask.reconnects')
+
 
 def build_key(unit, type, nr):
     return '{}_{}_{}'.format(unit, type, nr)
@@ -19,6 +43,25 @@ def build_key(unit, type, nr):
 def build_key_from_asset(asset):
     return '{}_{}_{}'.format(asset['central_unit'], asset['teletask_type'], asset['teletask_id'])
 
+def get_asset_key(unit, fnc, nr):
+    """the id of an asset as 1 int, the same as get_frame_key for its reports
+    """
+    return unit << 24 | fnc << 16 | nr
+
+def get_frame_key(frame, pos=0):
+    """the unit, fnc & nr of a REPORT frame as 1 int, read straight from the bytes of the frame (without decoding it)
+    Args:
+        pos (number): position of the start byte of the frame in 'frame' (a buffer with more than 1 frame)
+    """
+    return frame[pos + 3] << 24 | frame[pos + 4] << 16 | frame[pos + 5] << 8 | frame[pos + 6]
+
+def get_id(asset):
+    """the numbers that teletask uses to identify the asset in it's messages
+    Returns:
+        tuple: (unit, fnc, nr)
+    """
+    return (asset['central_unit'], teletask_type_to_function(asset['teletask_type']), asset['teletask_id'])
+
 def function_to_teletask_type(value):
     """converts a number value found from a teletask packet to a string for the function
     Args:
@@ -87,44 +130,374 @@ def teletask_type_to_function(value):
 
 
 async def start(config, STOP, callback):
-    """start the connection with the teletask machine
+    """start the connections with the teletask units. A unit that can't be reached now keeps on
+    trying to connect in the background, the others don't wait for it.
     Args:
-        config (json object): {"ip": "string", "port": number}
+        config (json object): {"ip": "string", "port": number, "window": number, "ack_timeout": number, "retries": number,
+            "units": [{"central_unit": number, "ip": "string", "port": number}]}. Without units, there is 1 connection (central_unit 1).
+            The values of a unit overwrite the ones of the section.
         STOP (asyncIO signal) so we can monitor when the application needs to be stopped
-        callback (async func) called when events arrive and need to be processed
+        callback (async func) called when events arrive and need to be processed: callback(unit, fnc, nr, values), all ids as numbers
+    Returns:
+        bool: True if at least 1 unit is connected
     """
-    global reader, writer, stop_signal, on_event, keep_alive_task
-    print("starting teletask connection")
-    try:
-        stop_signal = STOP
-        on_event = callback
-        reader, writer = await asyncio.open_connection(config['ip'], config['port'])
-        loop = asyncio.get_event_loop()
-        keep_alive_task = loop.create_task(run_keep_alive())
-        return True
-    except Exception as e:
-        print('error: {}'.format(e));
-        return False
+    global stop_signal, on_event
+    logger.info("starting teletask connection")
+    stop_signal = STOP
+    on_event = callback
+    connections.clear()
+    defaults = {name: value for name, value in config.items() if name != 'units'}
+    for unit_config in config.get('units') or [{}]:
+        unit_config = dict(defaults, **unit_config)
+        unit = unit_config.get('central_unit', 1)
+        connections[unit] = Connection(unit, unit_config)
+    results = await asyncio.gather(*[item.start() for item in connections.values()])
+    return any(results)
+
+
+def get_connection(unit):
+    """the connection for the central unit. When there is only 1 connection, it handles all the units
+    Returns:
+        Connection: None if the unit isn't configured
+    """
+    connection = connections.get(unit)
+    if not connection and len(connections) == 1:
+        connection = next(iter(connections.values()))
+    return connection
 
 
-async def run_keep_alive():
-    while True:
-        await asyncio.sleep(15)
-        if not waiting_for_ack:                         # if alraedy trying to send something, no need for a ping
-            await send([const.COMMAND_KEEP_ALIVE])
+class Connection:
+    """the connection with 1 teletask central unit: it has its own socket, reader loop, keep-alive,
+    command channel & state sync, so a unit that is slow or disconnected doesn't hold up the others.
+    """
 
+    def __init__(self, unit, config):
+        """
+        Args:
+            unit (number): the central unit nr
+            config (json object): the teletask config for this unit
+        """
+        self.unit = unit
+        self.config = config
+        self.reader = None                  # streams for reading & writing
+        self.writer = None
+        self.channel = None                 # CommandChannel that sends the commands and matches them with the acks
+        self.parser = None                  # FrameParser that extracts the messages from the incomming data
+        self.keep_alive_task = None         # task that runs making certain that the connection is kept open
+        self.is_connected = False
+        self.is_stopped = False             # flag gets set when we need to go out of the reader loop
+        self.loaded_items = None            # the assets of this unit, so their state can be requested again after a reconnect
+        self.monitored = set()              # get_asset_key of the loaded items, reports of other assets are dropped
+        self.functions = set()              # the functions of the loaded items, only these are logged
+        self.logged = set()                 # the functions for which logging was enabled on the current connection
+        self.not_synced = None              # during the startup sync: (unit, fnc, nr) -> asset for all the assets that haven't reported their state yet
+        self.all_synced = None              # asyncio.Event, set when not_synced becomes empty
+        self.sync_lock = asyncio.Lock()     # makes certain that a resync after a reconnect doesn't run together with the startup sync
+        self.sync_window = config.get('sync_window', sync_window)
+        self.sync_timeout = config.get('sync_timeout', sync_timeout)
+        self.sync_rounds = config.get('sync_rounds', sync_rounds)
+        metrics.gauge('teletask.{}.connected'.format(unit), lambda: self.is_connected)
+
+    async def start(self):
+        """connect and start the keep-alive
+        Returns:
+            bool: True if connected, if not, the reader loop keeps trying
+        """
+        self.keep_alive_task = asyncio.get_event_loop().create_task(self.run_keep_alive())
+        try:
+            await self.connect()
+            return True
+        except Exception as e:
+            logger.error('failed to connect to unit %s: %s', self.unit, e)
+            return False
+
+    async def connect(self):
+        """open the socket, every connection gets a fresh command channel & parser
+        """
+        config = self.config
+        timeout = config.get('connect_timeout', 5.0)
+        try:
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(config['ip'], config['port']), timeout)
+        except asyncio.TimeoutError:
+            raise ConnectionError('no answer within {} sec'.format(timeout))
+        self.channel = CommandChannel(self.writer.write, config.get('window', 4), config.get('ack_timeout', 1.0), config.get('retries', 1))
+        self.parser = FrameParser(self.handle_ack, self.monitored)
+        self.logged = set()                                         # a new connection logs nothing
+        self.is_connected = True
+
+    async def reconnect(self):
+        """the connection was lost: keep trying to connect again (with backoff) until it works or the app is stopped.
+        Once connected, the events are logged again and the states are requested again, home assistant only
+        gets the states that differ from what it already has.
+        Returns:
+            bool: True when connected again
+        """
+        self.is_connected = False
+        if self.channel:
+            self.channel.close()                                    # everything that was waiting for an ack is lost
+        if self.writer:
+            self.writer.close()
+        backoff = Backoff(self.config.get('reconnect_delay', 1.0), self.config.get('reconnect_max_delay', 60.0))
+        while not stop_signal.is_set():
+            delay = backoff.next()
+            logger.warning('teletask connection with unit %s lost, reconnecting in %.1f sec', self.unit, delay)
+            try:
+                await asyncio.wait_for(stop_signal.wait(), delay)
+                break
+            except asyncio.TimeoutError:
+                pass
+            try:
+                if not await self.connect_until_stopped():
+                    break
+            except Exception as e:
+                logger.warning('failed to reconnect to unit %s: %s', self.unit, e)
+                continue
+            RECONNECTS.inc()
+            logger.info('teletask connection with unit %s restored', self.unit)
+            if self.loaded_items:
+                asyncio.create_task(self.resync())
+            return True
+        return False
 
+    async def connect_until_stopped(self):
+        """connect, unless the app is stopped first (a connection attempt can take up to 'connect_timeout')
+        Returns:
+            bool: False if stopped before the connection was made
+        """
+        connect_task = asyncio.create_task(self.connect())
+        stop_task = asyncio.create_task(stop_signal.wait())
+        done, pending = await asyncio.wait((connect_task, stop_task), return_when=asyncio.FIRST_COMPLETED)
+        if connect_task in done:
+            stop_task.cancel()
+            await connect_task                                      # raises when the connection failed
+            return True
+        connect_task.cancel()
+        return False
 
-async def stop():
-    """close the connection
-    """
-    print('Close the teletask connection')
-    global is_stopped
-    keep_alive_task.cancel()
-    is_stopped = True
-    writer.close()
-    await writer.wait_closed()
-    print('teletask closed')
+    async def run_keep_alive(self):
+        while True:
+            await asyncio.sleep(15)
+            if self.is_connected and self.channel.is_idle():        # if alraedy trying to send something, no need for a ping
+                if not await self.send([const.COMMAND_KEEP_ALIVE]) and self.is_connected:
+                    logger.warning('no response on keep alive from unit %s, closing the connection', self.unit)
+                    self.writer.close()                             # the reader will see the connection close and reconnect
+
+    async def stop(self):
+        """close the connection
+        """
+        logger.info('Close the teletask connection with unit %s', self.unit)
+        if self.keep_alive_task:
+            self.keep_alive_task.cancel()
+        if self.channel:
+            self.channel.close()
+        self.is_stopped = True
+        self.is_connected = False
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):              # connection was already broken
+                pass
+        logger.info('teletask unit %s closed', self.unit)
+
+    async def read_block(self, nr_bytes):
+        """blocks until something is read or stop has been set
+        Args:
+            nr_bytes (number): max nr of bytes to read
+        Returns:
+            bytes: the data that was read or None
+        """
+        read_task = asyncio.create_task(self.read_safe(nr_bytes))
+        stop_task = asyncio.create_task(stop_signal.wait())
+        pending = (read_task, stop_task)
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        if stop_task in done:
+            read_task.cancel()
+            await self.stop()
+            return None
+        else:
+            stop_task.cancel()
+            return await read_task
+
+    async def read_safe(self, nr_bytes):
+        try:
+            return await self.reader.read(nr_bytes)
+        except (ConnectionError, OSError) as e:
+            logger.warning('teletask read from unit %s failed: %s', self.unit, e)
+            return b''
+
+    def handle_ack(self):
+        """called by the frame parser whenever teletask acknowledged a command
+        """
+        if self.channel:
+            self.channel.handle_ack()
+
+    async def read(self):
+        """reads and dispatches the messages of this unit as needed.
+        """
+        while not self.is_stopped:
+            if not self.is_connected:                               # the first connect failed
+                if not await self.reconnect():
+                    await self.stop()
+                    break
+                continue
+            data = await self.read_block(READ_SIZE)
+            if data is None:                                        # stopped
+                break
+            if not data:                                            # connection lost
+                if not await self.reconnect():
+                    await self.stop()
+                    break
+                continue
+            read_at = time.perf_counter()
+            frames = self.parser.feed(data)                         # frames split over 2 reads are kept in the parser's buffer
+            PARSE_TIME.observe(time.perf_counter() - read_at)
+            FRAMES_IN.inc(len(frames))
+            for frame in frames:
+                try:
+                    if tracer.enabled:
+                        tracer.trace('Received', frame)
+                    await self.process_message(memoryview(frame)[2:])
+                    EVENT_LATENCY.observe(time.perf_counter() - read_at)
+                except Exception as ex:
+                    logger.exception('failed to process message: %s', ex)
+
+    async def process_message(self, msg):
+        """checks the incomming message and dispatches it as needed
+        Args:
+            msg (bytearray): list of bytes that were read
+        """
+        if not on_event:
+            logger.error("internal error: no event callback")
+            return
+        if msg[0] == const.COMMAND_REPORT:
+            unit, fnc, nr, values = codec.decode_report(msg)
+            if self.not_synced:
+                self.mark_synced(unit, fnc, nr)
+            await on_event(unit, fnc, nr, values)
+
+    async def send(self, msg):
+        """sends the command to teletask and waits until it is acknowledged. Other commands can be sent
+        while waiting, so call this concurrently (ex: asyncio.gather) to send multiple commands at once.
+        Args:
+            msg (bytes or list): the command bytes, without start byte, length & checksum (see codec)
+        Returns:
+            bool: True if teletask acknowledged the command, False if it got lost or the unit isn't connected.
+        """
+        if not self.is_connected:
+            return False
+        body = bytearray((FRAME_START, len(msg) + 2))
+        body.extend(msg)
+        body.append(get_checksum(body))
+        frame = bytes(body)
+        if tracer.enabled:
+            tracer.trace('Send', frame)
+        return await self.channel.submit(frame)
+
+    def mark_synced(self, unit, fnc, nr):
+        """the asset reported it's state, so it no longer needs to be requested during the startup sync
+        """
+        if self.not_synced.pop((unit, fnc, nr), None) and not self.not_synced:
+            self.all_synced.set()
+
+    async def request_state(self, asset):
+        fnc = teletask_type_to_function(asset['teletask_type'])
+        return await self.send(codec.encode_get(asset['central_unit'], fnc, asset['teletask_id']))
+
+    async def sync_states(self, items):
+        """request the current values so home-assistant is up to date.
+        The GETs are sent in windows of 'sync_window' commands. Assets that didn't report their state
+        after a round are requested again (up to 'sync_rounds' times).
+        Args:
+            items (list): the assets to sync
+        """
+        async with self.sync_lock:
+            await self.sync_states_locked(items)
+
+    async def sync_states_locked(self, items):
+        start_at = time.monotonic()
+        self.not_synced = {}
+        for asset in items:
+            self.not_synced[get_id(asset)] = asset
+        self.all_synced = asyncio.Event()
+        try:
+            for attempt in range(self.sync_rounds):
+                if not self.not_synced:
+                    break
+                to_request = list(self.not_synced.values())
+                logger.info("request teletask states of unit %s: %d assets, round %d", self.unit, len(to_request), attempt + 1)
+                for i in range(0, len(to_request), self.sync_window):
+                    await asyncio.gather(*[self.request_state(asset) for asset in to_request[i:i + self.sync_window]])
+                try:
+                    await asyncio.wait_for(self.all_synced.wait(), self.sync_timeout)
+                except asyncio.TimeoutError:
+                    pass
+            if self.not_synced:
+                names = [asset['name'] for asset in self.not_synced.values()]
+                logger.warning("teletask sync of unit %s incomplete after %.2f sec, no state for: %s", self.unit, time.monotonic() - start_at, names)
+            else:
+                logger.info("time to fully synced: %.2f sec for %d assets of unit %s", time.monotonic() - start_at, len(items), self.unit)
+        finally:
+            self.not_synced = None
+            self.all_synced = None
+
+    def set_items(self, items):
+        """the assets of this unit, they determine which functions are logged and which reports are processed
+        """
+        self.loaded_items = items
+        ids = [get_id(asset) for asset in items]
+        self.monitored = {get_asset_key(*id) for id in ids}
+        if self.parser:
+            self.parser.monitored = self.monitored
+        self.functions = {fnc for unit, fnc, nr in ids}
+
+    async def enable_logging(self):
+        """start monitoring the functions of the assets so we receive their events, the functions that are
+        no longer used (config reload) are stopped. Only the changes are sent.
+        """
+        changes = [(function, True) for function in self.functions - self.logged]
+        changes += [(function, False) for function in self.logged - self.functions]
+        if not changes:
+            return
+        logger.info("logging teletask events of unit %s for functions %s", self.unit, sorted(self.functions))
+        results = await asyncio.gather(*[self.send(codec.encode_log(function, is_on)) for function, is_on in changes])
+        for (function, is_on), is_acked in zip(changes, results):
+            if not is_acked:                                # tried again with the next resync or reload
+                continue
+            if is_on:
+                self.logged.add(function)
+            else:
+                self.logged.discard(function)
+
+    async def resync(self):
+        """after a reconnect: log the events again & request the states of all the assets again. Events that
+        happened while disconnected were never reported, so every state can be stale. Assets that report
+        during the sync aren't requested again in the later rounds.
+        """
+        try:
+            await self.enable_logging()
+            await self.sync_states(self.loaded_items)
+        except Exception as e:
+            logger.exception('teletask resync of unit %s failed: %s', self.unit, e)
+
+    async def load_assets(self, items):
+        """log the events & request the states of the assets of this unit. When the unit isn't
+        connected, this happens as soon as it is.
+        """
+        self.set_items(items)
+        if not self.is_connected:
+            logger.warning('teletask unit %s not connected, its states are requested once it is', self.unit)
+            return
+        await self.enable_logging()
+        await self.sync_states(items)
+
+    async def update_assets(self, to_sync):
+        """after a config reload: log the functions that are new, stop the ones that are no longer needed
+        and request the states of the new & changed assets
+        """
+        await self.enable_logging()
+        if to_sync:
+            await self.sync_states(to_sync)
 
 
 def get_checksum(msg):
@@ -133,127 +506,79 @@ def get_checksum(msg):
         value += byte
     return value  % 256
 
-def verify_checksum(msg):
-    """checks if the checksum is correct for the message
-    Args:
-        msg (bytearray): list of bytes that were read
+class FrameParser:
+    """incremental parser for the byte stream that teletask sends.
+    Data is appended to a buffer that is kept between reads, so frames that are split over
+    multiple reads are no longer lost. Only complete frames with a valid checksum are returned,
+    garbage bytes and frames with a bad checksum are skipped until the next start byte.
+    A frame looks like: [STX, length, command, ..., checksum] where length counts all bytes but the checksum.
     """
-    value = get_checksum(msg[:-1])
-    if value != msg[-1]:
-        raise Exception("checksum failed")
 
-
-def convert_sensor(msg):
-    value = round(int.from_bytes(msg[6:8], "big") / 10 - 273, 2)
-    # target = int.from_bytes(msg[8:10], "big")
-    # day = int.from_bytes(msg[10:12], "big")
-    # night = int.from_bytes(msg[12:14], "big")
-    # result = [value, target, day, night]
-    return value
-
-
-async def process_message(msg):
-    """checks the incomming message and dispatches it as needed
-    Args:
-        msg (bytearray): list of bytes that were read
-    """
-    if not on_event:
-        print("internal error: no event callback")
-        return
-    if msg[0] == const.COMMAND_REPORT:
-        unit = msg[1]
-        type = function_to_teletask_type(msg[2])
-        nr = int.from_bytes(msg[3:5], "big")
-        values = None
-        if msg[2] == const.FNC_MOTORFNC:
-            values = [msg[6], msg[7]]
-        elif msg[2] == const.FNC_SENSOR:
-            values = convert_sensor(msg)
-        else:
-            values = [msg[6]]
-        await on_event(unit, type, nr, values)
-
-
-
-async def read_block(nr_bytes):
-    """blocks until something is read or stop has been set
-    Args:
-        nr_bytes (number): nr of bytes to read
-    Returns:
-        byte_array: list of bytes read or None
-    """
-    read_task = asyncio.create_task(reader.read(nr_bytes))
-    stop_task = asyncio.create_task(stop_signal.wait())
-    pending = (read_task, stop_task)
-    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
-    if stop_task in done:
-        await stop()
-        return None
-    else:
-        value = await done.pop()
-        results = []
-        for x in value:
-            results.append(x)
-        # print('Received: {}'.format(results))
-        return results
-
-
-async def read_messages():
-    global waiting_for_ack
-    while True:
-        bytes = await read_block(100)
-        if not bytes or len(bytes) == 0:
-            return None
-        else:
-            curPos = 0
-            msgs = []
-            while curPos < len(bytes):
-                if bytes[0] == const.COMMAND_ACK and waiting_for_ack:
-                    waiting_for_ack.set()
-                    waiting_for_ack = None
-                    curPos += 1
-                elif bytes[curPos] != 0x02:                               # incorrect start of message
-                    curPos += 1
+    def __init__(self, on_ack=None, monitored=None):
+        """
+        Args:
+            on_ack (func): called (without arguments) for every ack that is found in the stream
+            monitored (set): get_asset_key of the assets whose reports are returned, the reports of other assets
+                are dropped before they are copied out of the buffer. Default: all the reports are returned
+        """
+        self.buffer = bytearray()
+        self.on_ack = on_ack
+        self.monitored = monitored
+        self.checksum_errors = 0                            # some stats, so we can see how healthy the connection is
+        self.skipped_bytes = 0
+        self.resync_end = 0                                 # position in the buffer up to where a rejected frame reached, no acks in there
+
+    def feed(self, data):
+        """adds the data to the buffer and extracts all the complete frames
+        Args:
+            data (bytes): the bytes that were read from the stream
+        Returns:
+            list: the frames (as bytes, including start byte and checksum) that were found
+        """
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        pos = 0
+        size = len(buffer)
+        resync_end = self.resync_end
+        monitored = self.monitored
+        with memoryview(buffer) as view:
+            while pos < size:
+                start_byte = buffer[pos]
+                if start_byte == FRAME_START:
+                    if pos + 1 >= size:                                 # length not yet received
+                        break
+                    length = buffer[pos + 1]
+                    if length < MIN_FRAME_LENGTH or length > MAX_FRAME_LENGTH:   # can't be the start of a frame, resync
+                        self.skipped_bytes += 1
+                        resync_end = max(resync_end, pos + 2)           # the length byte isn't an ack
+                        pos += 1
+                        continue
+                    end = pos + length + 1                              # +1 for the checksum
+                    if end > size:                                      # rest of the frame is in the next read
+                        break
+                    if sum(view[pos:end - 1]) % 256 != buffer[end - 1]:
+                        self.checksum_errors += 1
+                        logger.warning("checksum failed")
+                        resync_end = max(resync_end, end)               # the bytes of the frame are no acks, only look for a start byte
+                        pos += 1                                        # resync on the next start byte
+                        continue
+                    if monitored is not None and buffer[pos + 2] == const.COMMAND_REPORT and (length < 7 or get_frame_key(buffer, pos) not in monitored):
+                        FRAMES_DROPPED.inc()                            # report of an asset that isn't in the config
+                    else:
+                        frames.append(bytes(view[pos:end]))
+                    pos = end
                 else:
-                    length = bytes[curPos + 1]
-                    msgs.append(bytes[curPos:curPos+length+1])
-                    curPos += length + 1
-            if len(msgs) > 0:
-                return msgs
-
-async def read():
-    """reads and dispatches the messages as needed.
-    """
-    while not is_stopped:
-        try:
-            msgs = await read_messages();                       # get all possible messages received in 1 read 
-            if not msgs:                                      # streamreader has been closed
-                break
-            for msg in msgs:
-                verify_checksum(msg)
-                body = msg[1:]
-                print(f'Received: {body!r}')
-                await process_message(body[1:])
-        except Exception as ex:
-            print(ex)
-
-
-async def send(msg):
-    global waiting_for_ack
-    if waiting_for_ack:                                             # if there is a previous write action, wait till it's done
-        await asyncio.wait_for(waiting_for_ack.wait(), 2.0) 
-    body = [0x02, 0x00] + msg
-    body[1] = len(body)
-    body.append(get_checksum(body))
-    print(f'Send: {body!r}')
-    waiting_for_ack = asyncio.Event()
-    writer.write(bytearray(body))
-    await writer.drain()
-    try:
-        await asyncio.wait_for(waiting_for_ack.wait(), 1.0)           # need to havea  response in time, otherwise, we regard it as lost
-    except asyncio.TimeoutError:
-        print('message ack timed out')
-    waiting_for_ack = None
+                    if start_byte == const.COMMAND_ACK and pos >= resync_end:
+                        if self.on_ack:
+                            self.on_ack()
+                    else:                                               # incorrect start of message
+                        self.skipped_bytes += 1
+                    pos += 1
+        if pos:
+            del buffer[:pos]
+        self.resync_end = max(0, resync_end - pos)
+        return frames
 
 
 def value_to_number(value):
@@ -270,12 +595,7 @@ def value_to_number(value):
     elif  value.isnumeric() == True:
         return int(value)
     else:
-        print("error: invalid value: {}, can't convert".format(value))
-
-def split_2_bytes(value):
-    low = value % 255
-    high = math.trunc(value / 255)
-    return low, high
+        logger.error("invalid value: %s, can't convert", value)
 
 async def set_actuator(asset, value):
     """sends an actuator command to the specified asset
@@ -283,36 +603,58 @@ async def set_actuator(asset, value):
     Args:
         asset (object): the asset definition
         value (number): value to send
+    Returns:
+        bool: True if teletask acknowledged the command
     """
-    print("teletask send value {} to {}".format(value, asset['name']))
+    logger.debug("teletask send value %s to %s", value, asset['name'])
     fnc = teletask_type_to_function(asset['teletask_type'])
-    teletask_id_low, teletask_id_high = split_2_bytes(asset['teletask_id'])
     value = value_to_number(value)
     if not value == None:
-        msg = [const.COMMAND_SET, asset['central_unit'], fnc, teletask_id_high, teletask_id_low, value]
-        await send(msg)
+        connection = get_connection(asset['central_unit'])
+        if not connection:
+            logger.error("no connection for central unit %s of %s", asset['central_unit'], asset['name'])
+            return False
+        return await connection.send(codec.encode_set(asset['central_unit'], fnc, asset['teletask_id'], value))
+    return False
     
 
-async def load_assets(items):
-    if not writer:
-        raise Exception("teletask not connected")
-    # start monitoring all the functions of teletask so we can receive
-    # events
-    to_monitor = [const.FNC_RELAY, const.FNC_DIMMER, const.FNC_MOTORFNC, 
-        const.FNC_LOCMOOD, const.FNC_TIMEDMOOD, const.FNC_FLAG, const.FNC_SENSOR,
-        const.FNC_PROCES, const.FNC_REGIME, const.FNC_SERVICE, const.FNC_MESSAGE,
-        const.FNC_COND]
-    print("start logging teletask events")
-    for function in to_monitor:
-        msg = [const.COMMAND_LOG, function, const.SET_ON]
-        await send(msg)
-    # request the current values so home-assistant is up to date.
-    print("request teletask states")
-    covers = []
+async def read():
+    """reads and dispatches the messages of all the units until stop has been set, every unit has its own reader loop.
+    """
+    await asyncio.gather(*[item.read() for item in connections.values()])
+
+
+def group_by_connection(items):
+    """
+    Returns:
+        dict: Connection -> the assets of its unit
+    """
+    per_connection = {}
     for asset in items:
-        if asset['component'] == 'cover':
-            covers.append(asset)
-        fnc = teletask_type_to_function(asset['teletask_type'])
-        teletask_id_low, teletask_id_high = split_2_bytes(asset['teletask_id'])
-        msg = [const.COMMAND_GET, asset['central_unit'], fnc, teletask_id_high, teletask_id_low]
-        await send(msg)
+        connection = get_connection(asset['central_unit'])
+        if connection:
+            per_connection.setdefault(connection, []).append(asset)
+        else:
+            logger.error("no connection for central unit %s of %s", asset['central_unit'], asset['name'])
+    return per_connection
+
+
+async def load_assets(items):
+    """log the events & request the states of all the assets, every unit does this for its own assets, at the same time
+    """
+    per_connection = group_by_connection(items)
+    await asyncio.gather(*[connection.load_assets(assets) for connection, assets in per_connection.items()])
+
+
+async def update_assets(items, to_sync):
+    """the list of assets changed (config reload): remember the new list for resyncs, log the functions
+    that are used now and only request the states of the assets that are new or changed
+    Args:
+        items (list): all the assets
+        to_sync (list): the new & changed assets
+    """
+    per_connection = group_by_connection(items)
+    for connection in connections.values():
+        connection.set_items(per_connection.get(connection, []))
+    to_sync = group_by_connection(to_sync)
+    await asyncio.gather(*[connection.update_assets(to_sync.get(connection)) for connection in connections.values() if connection.is_connected])
@@ -0,0 +1,46 @@
+"""round trips through the codec for every layout, with nrs that need both bytes
+"""
+import pytest
+
+import codec
+import teletask_const as const
+
+STATES = {                                  # a state for every layout that isn't the default one
+    const.FNC_DIMMER: codec.DimmerState(42),
+    const.FNC_MOTORFNC: codec.MotorState(const.SET_MTRDOWN, 1),
+    const.FNC_SENSOR: codec.SensorState(21.5, 22.0, 21.0, 17.5),
+}
+NRS = (1, 254, 255, 256, 300, 65535)
+
+
+def test_every_layout_has_a_state():
+    assert {fnc for fnc, layout in codec.LAYOUTS.items() if layout is not codec.DEFAULT} == set(STATES)
+
+
+@pytest.mark.parametrize('nr', NRS)
+@pytest.mark.parametrize('fnc', sorted(codec.LAYOUTS))
+def test_report_round_trip(fnc, nr):
+    state = STATES.get(fnc, codec.State(255))
+    msg = codec.encode_report(1, fnc, nr, state)
+    assert codec.decode_report(memoryview(msg)) == (1, fnc, nr, state)
+    assert codec.decode_report(msg + b'\x7f') == (1, fnc, nr, state)          # a trailing checksum is ignored
+
+
+def test_short_sensor_report():
+    msg = bytes([const.COMMAND_REPORT, 1, const.FNC_SENSOR, 0, 5, 0, 0x0B, 0x7A])     # only the value, no setpoints
+    assert codec.decode_report(msg) == (1, const.FNC_SENSOR, 5, codec.SensorState(20.8, None, None, None))
+
+
+@pytest.mark.parametrize('nr', NRS)
+def test_encode_set(nr):
+    assert codec.encode_set(1, const.FNC_RELAY, nr, const.SET_ON) == bytes([const.COMMAND_SET, 1, const.FNC_RELAY, nr >> 8, nr & 0xFF, const.SET_ON])
+
+
+@pytest.mark.parametrize('nr', NRS)
+def test_encode_get(nr):
+    assert codec.encode_get(2, const.FNC_DIMMER, nr) == bytes([const.COMMAND_GET, 2, const.FNC_DIMMER, nr >> 8, nr & 0xFF])
+
+
+def test_encode_log():
+    assert codec.encode_log(const.FNC_RELAY) == bytes([const.COMMAND_LOG, const.FNC_RELAY, const.SET_ON])
+    assert codec.encode_log(const.FNC_RELAY, False) == bytes([const.COMMAND_LOG, const.FNC_RELAY, const.SET_OFF])